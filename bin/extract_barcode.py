@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+import argparse
+import itertools
+import sys
+import time
+from collections import defaultdict
+from multiprocessing import Pool
+
+import parse_protocol
+import pyfastx
+import utils
+from protocol_cmd import Starsolo
+
+logger = utils.get_logger(__name__)
+SEGMENT_STATUS = ["perfect", "corrected", "invalid"]
+
+# set in each worker by init_worker
+_cb_slices = _umi_slice = _mismatch_list = _linker_matcher = None
+
+
+def init_worker(pattern, whitelist_files, n_mismatch, linker_files, max_shift, edit_distance=False):
+    global _cb_slices, _umi_slice, _mismatch_list, _linker_matcher
+    pattern_dict = parse_protocol.parse_pattern(pattern)
+    _cb_slices = pattern_dict["C"]
+    _umi_slice = pattern_dict["U"][0]
+    _raw_list, _mismatch_list = parse_protocol.get_raw_mismatch(
+        whitelist_files, n_mismatch, edit_distance=edit_distance
+    )
+    if linker_files and max_shift:
+        _linker_matcher = parse_protocol.LinkerMatcher(pattern_dict, linker_files, max_shift)
+
+
+def correct_seq(seq, cb_slices, umi_slice, mismatch_list):
+    """
+    Returns:
+        cb: corrected barcode segments joined without separator; None if any segment is invalid
+        umi
+        status: index of SEGMENT_STATUS for each segment
+
+    >>> mismatch_list = [parse_protocol.MismatchIndex(["AAA"]), parse_protocol.MismatchIndex(["CCC"])]
+    >>> pattern_dict = parse_protocol.parse_pattern("C3L2C3U4")
+    >>> correct_seq("AAATTCCCGGGG", pattern_dict["C"], pattern_dict["U"][0], mismatch_list)
+    ('AAACCC', 'GGGG', [0, 0])
+    >>> correct_seq("ATATTCCCGGGG", pattern_dict["C"], pattern_dict["U"][0], mismatch_list)
+    ('AAACCC', 'GGGG', [1, 0])
+    >>> correct_seq("ATATTGGGGGGG", pattern_dict["C"], pattern_dict["U"][0], mismatch_list)
+    (None, 'GGGG', [1, 2])
+    """
+    cb_list = []
+    status = []
+    for sub_slice, mismatch_index in zip(cb_slices, mismatch_list):
+        bc = seq[sub_slice]
+        index = mismatch_index.get_index(bc)
+        if index is None:
+            status.append(2)
+            continue
+        corrected = mismatch_index.seqs[index]
+        status.append(0 if corrected == bc else 1)
+        cb_list.append(corrected)
+    cb = "".join(cb_list) if len(cb_list) == len(cb_slices) else None
+    return cb, seq[umi_slice], status
+
+
+def rescue_seq(seq, linker_matcher, cb_slices, umi_slice, mismatch_list):
+    """
+    Re-slice barcode segments and UMI at the linker positions found by linker_matcher.
+
+    Returns:
+        shifts, cb_slices, umi_slice, cb, umi, status; None if the read can not be rescued
+    """
+    shifts = linker_matcher.find_shifts(seq)
+    if not shifts or not any(shifts):
+        return None
+    new_slices = linker_matcher.shift_slices(cb_slices + [umi_slice], shifts)
+    if new_slices is None:
+        return None
+    cb_slices, umi_slice = new_slices[:-1], new_slices[-1]
+    cb, umi, status = correct_seq(seq, cb_slices, umi_slice, mismatch_list)
+    if cb is None:
+        return None
+    return shifts, cb_slices, umi_slice, cb, umi, status
+
+
+def format_shifts(shifts):
+    """
+    >>> format_shifts((1, 1, 0))
+    '+1/+1/0'
+    """
+    return "/".join(f"{x:+d}" if x else "0" for x in shifts)
+
+
+def extract_chunk(chunk):
+    """
+    Args:
+        chunk: list of (seq, qual) of R1
+    Returns:
+        list of (seq, qual) of the new R1: corrected barcode + umi. Invalid barcodes are replaced with N.
+        segment_counts: [[n_perfect, n_corrected, n_invalid] for each segment]
+        n_valid: number of reads with all segments valid
+        rescued: {shifts: number of reads rescued by linker anchoring}
+    """
+    cb_len = sum(x.stop - x.start for x in _cb_slices)
+    umi_len = _umi_slice.stop - _umi_slice.start
+    segment_counts = [[0] * len(SEGMENT_STATUS) for _ in _cb_slices]
+    n_valid = 0
+    rescued = defaultdict(int)
+    out = []
+    for seq, qual in chunk:
+        cb_slices, umi_slice = _cb_slices, _umi_slice
+        cb, umi, status = correct_seq(seq, cb_slices, umi_slice, _mismatch_list)
+        if cb is None and _linker_matcher:
+            res = rescue_seq(seq, _linker_matcher, cb_slices, umi_slice, _mismatch_list)
+            if res:
+                shifts, cb_slices, umi_slice, cb, umi, status = res
+                rescued[format_shifts(shifts)] += 1
+        for counts, x in zip(segment_counts, status):
+            counts[x] += 1
+        if cb is None:
+            cb = "N" * cb_len
+        else:
+            n_valid += 1
+        cb_qual = "".join(qual[x] for x in cb_slices).ljust(cb_len, "#")
+        out.append((cb + umi.ljust(umi_len, "N"), cb_qual + qual[umi_slice].ljust(umi_len, "#")))
+    return out, segment_counts, n_valid, rescued
+
+
+def get_extract_pattern(pattern):
+    """
+    pattern of the extracted R1.
+
+    >>> get_extract_pattern("C9L16C9L16C9L1U12T18")
+    'C9C9C9U12'
+    """
+    pattern_dict = parse_protocol.parse_pattern(pattern)
+    cb_str = "".join(f"C{x.stop - x.start}" for x in pattern_dict["C"])
+    umi = pattern_dict["U"][0]
+    return f"{cb_str}U{umi.stop - umi.start}"
+
+
+def get_whitelist_str(whitelist_files):
+    """
+    --soloCBwhitelist value. STARsolo can not read gzip files, so each .gz whitelist is decompressed in a process substitution.
+
+    >>> get_whitelist_str(["bc1.txt.gz", "bc2.txt"])
+    '<(gzip -cdf bc1.txt.gz) bc2.txt'
+    """
+    return " ".join(f"<(gzip -cdf {x})" if x.endswith(".gz") else x for x in whitelist_files)
+
+
+class ExtractBarcode:
+    """
+    Extract and correct barcode and UMI from R1, so that STARsolo only needs exact whitelist matching
+    at fixed positions instead of CB_UMI_Complex with EditDist_2.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.starsolo = Starsolo(args)
+        self.pattern = self.starsolo.pattern
+        pattern_dict = parse_protocol.parse_pattern(self.pattern)
+        self.whitelist_files = self.starsolo.whitelist_files
+        self.linker_files = []
+        if self.starsolo.protocol != "new":
+            protocol_meta = parse_protocol.get_protocol_dict(args.assets_dir)[self.starsolo.protocol]
+            self.linker_files = protocol_meta.get("linker", [])
+        if len(pattern_dict["C"]) != len(self.whitelist_files):
+            sys.exit(
+                f"Error: extract_barcode needs one whitelist file per barcode segment. "
+                f"pattern: {self.pattern}, whitelist: {self.whitelist_files}"
+            )
+        self.out_fq1 = f"{args.sample}_R1.fq.gz"
+        self.out_fq2 = f"{args.sample}_R2.fq.gz"
+        self.stats = {}
+
+    def iter_chunks(self):
+        """Yield (R1 chunk, R2 chunk); R1 chunk is a list of (seq, qual)"""
+        for fq1, fq2 in zip(self.starsolo.fq1_list, self.starsolo.fq2_list):
+            # pyfastx.Fastx restarts on each iter() call; islice needs a plain generator
+            reads1 = (x for x in pyfastx.Fastx(fq1))
+            reads2 = (x for x in pyfastx.Fastx(fq2))
+            while True:
+                chunk1 = list(itertools.islice(reads1, self.args.chunk_size))
+                chunk2 = list(itertools.islice(reads2, self.args.chunk_size))
+                if len(chunk1) != len(chunk2):
+                    sys.exit(f"Error: {fq1} and {fq2} do not have the same number of reads!")
+                if not chunk1:
+                    break
+                yield chunk1, chunk2
+
+    @utils.add_log
+    def run(self):
+        n_read = n_valid = 0
+        segment_counts = [[0] * len(SEGMENT_STATUS) for _ in self.whitelist_files]
+        rescued = defaultdict(int)
+        start = time.time()
+        initargs = (
+            self.pattern,
+            self.whitelist_files,
+            self.args.n_mismatch,
+            self.linker_files,
+            self.args.max_shift,
+            self.args.edit_distance,
+        )
+        pool = Pool(self.args.thread, initializer=init_worker, initargs=initargs)
+        out1 = utils.openfile(self.out_fq1, "wt", compresslevel=1)
+        out2 = utils.openfile(self.out_fq2, "wt", compresslevel=1)
+        with pool, out1, out2:
+            chunks = self.iter_chunks()
+            while True:
+                # bounded number of chunks in memory
+                batch = list(itertools.islice(chunks, self.args.thread * 2))
+                if not batch:
+                    break
+                results = pool.map(extract_chunk, [[(seq, qual) for _name, seq, qual in c1] for c1, _c2 in batch])
+                for (chunk1, chunk2), (out, counts, chunk_valid, chunk_rescued) in zip(batch, results):
+                    for (name, _seq, _qual), (seq, qual) in zip(chunk1, out):
+                        out1.write(utils.fastq_str(name, seq, qual))
+                    for name, seq, qual in chunk2:
+                        out2.write(utils.fastq_str(name, seq, qual))
+                    n_read += len(chunk1)
+                    n_valid += chunk_valid
+                    for shifts, x in chunk_rescued.items():
+                        rescued[shifts] += x
+                    for total, cur in zip(segment_counts, counts):
+                        for i, x in enumerate(cur):
+                            total[i] += x
+        elapsed = time.time() - start
+        utils.add_rows(n_read)
+        self.add_stats(n_read, n_valid, segment_counts, rescued, elapsed)
+        self.write_cmd()
+        utils.write_json(self.stats, f"{self.args.sample}.scrna.extract_barcode.json")
+
+    def add_stats(self, n_read, n_valid, segment_counts, rescued, elapsed):
+        self.stats["Protocol"] = self.starsolo.protocol
+        self.stats["Raw Reads"] = n_read
+        self.stats["Valid Reads"] = n_valid
+        for i, counts in enumerate(segment_counts, start=1):
+            for status, x in zip(SEGMENT_STATUS, counts):
+                self.stats[f"Barcode Segment {i} {status}"] = x
+        self.stats["Rescued Reads"] = sum(rescued.values())
+        for shifts, x in sorted(rescued.items(), key=lambda x: x[1], reverse=True):
+            self.stats[f"Rescued Reads Linker Shift {shifts}"] = x
+        self.stats["Time Used(s)"] = round(elapsed, 2)
+        reads_per_sec = n_read / elapsed if elapsed else 0
+        self.stats["Reads per Second"] = int(reads_per_sec)
+        self.stats["Reads per Second per Core"] = int(reads_per_sec / self.args.thread)
+        logger.info(self.stats)
+
+    def write_cmd(self):
+        pattern_args = Starsolo.get_solo_pattern(get_extract_pattern(self.pattern), match_type="Exact")
+        whitelist_str = get_whitelist_str(self.whitelist_files)
+        cmd = pattern_args + f" --soloCBwhitelist {whitelist_str}  --readFilesCommand zcat"
+        logger.info(cmd)
+        with open(self.starsolo.cmd_fn, "w") as f:
+            f.write(cmd)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract and correct barcode and UMI from R1")
+    parser.add_argument("--sample", required=True)
+    parser.add_argument("--fq1", required=True)
+    parser.add_argument("--fq2", required=True)
+    parser.add_argument("--assets_dir", required=True)
+    parser.add_argument("--protocol", required=True)
+    parser.add_argument("--whitelist")
+    parser.add_argument("--pattern")
+    parser.add_argument("--thread", type=int, default=1)
+    parser.add_argument("--chunk_size", type=int, default=10000, help="number of reads sent to a worker at a time")
+    parser.add_argument("--n_mismatch", type=int, default=1, help="allowed number of mismatch bases per segment")
+    parser.add_argument(
+        "--edit_distance", action="store_true", help="allow insertions and deletions as well as mismatches per segment"
+    )
+    parser.add_argument(
+        "--max_shift", type=int, default=2, help="max linker shift to rescue reads with indels. 0 to disable"
+    )
+    parser.add_argument("--max_read", type=int, default=100000)
+    parser.add_argument("--early_stop", action="store_true")
+    parser.add_argument("--sampling", choices=["spread", "head"], default="spread")
+    parser.add_argument("--no_batch", action="store_true")
+    parser.add_argument("--cache_dir")
+    parser.add_argument("--force_detect", action="store_true")
+    parser.add_argument("--cache_size", type=int, default=1000)
+    args = parser.parse_args()
+
+    runner = ExtractBarcode(args)
+    runner.run()
+    runner.starsolo.write_stats("scrna")
+    utils.write_perf(args.sample, "scrna", "extract_barcode")
@@ -2,23 +2,16 @@
 
 import collections
 import csv
-import gzip
 import os
 import re
 import sys
 
+import utils
+
 PATTERN = re.compile(r'(\S+?)\s*"(.*?)"')
 gtf_row = collections.namedtuple("gtf_row", "seqname source feature start end score strand frame attributes")
 
 
-def generic_open(file_name, *args, **kwargs):
-    if file_name.endswith(".gz"):
-        file_obj = gzip.open(file_name, *args, **kwargs)
-    else:
-        file_obj = open(file_name, *args, **kwargs)
-    return file_obj
-
-
 class GtfParser:
     def __init__(self, gtf_fn):
         self.gtf_fn = gtf_fn
@@ -53,7 +46,7 @@ class GtfParser:
             row: list
             gtf_row
         """
-        with generic_open(self.gtf_fn, mode="rt") as f:
+        with utils.openfile(self.gtf_fn, newline="") as f:
             reader = csv.reader(f, delimiter="\t")
             for i, row in enumerate(reader, start=1):
                 if len(row) == 0:
@@ -82,9 +75,35 @@ class GtfParser:
                 yield row, gtf_row(seqname, source, feature, start, end, score, strand, frame, attributes)
 
 
+def get_attribute(attributes_str, key, gp):
+    """
+    Find the value of one key without parsing all attributes. Only the common `; key "value"` form with a single
+    occurrence of key is read directly; other lines are parsed with GtfParser.get_properties_dict.
+
+    >>> gp = GtfParser(None)
+    >>> get_attribute('gene_id "g1"; gene_biotype "lncRNA";', "gene_biotype", gp)
+    'lncRNA'
+    >>> get_attribute('gene_id "g1";', "gene_biotype", gp) is None
+    True
+    >>> get_attribute('gene_name "gene_biotype"; gene_biotype "lncRNA";gene_biotype"TEC";', "gene_biotype", gp)
+    'TEC'
+    """
+    if key not in attributes_str:
+        return None
+    i = attributes_str.find(f'{key} "')
+    if i != -1 and (i == 0 or attributes_str[i - 2 : i] == "; ") and attributes_str.count(key) == 1:
+        start = i + len(key) + 2
+        end = attributes_str.find('"', start)
+        if end != -1:
+            value = attributes_str[start:end]
+            if ";" not in value:
+                return value.strip()
+    return gp.get_properties_dict(attributes_str).get(key)
+
+
 def filter_gtf(gtf_fn, out_fn, allow):
     """
-    Filter attributes
+    Filter attributes. Lines are scanned for the keys in allow only and kept lines are written unchanged.
 
     Args:
         allow: {
@@ -95,23 +114,31 @@ def filter_gtf(gtf_fn, out_fn, allow):
     gp = GtfParser(gtf_fn)
     n_filter = 0
 
-    with open(out_fn, "w") as f:
-        # quotechar='' is not allowed since python3.11
-        writer = csv.writer(f, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar=None)
-        for row, grow in gp.gtf_reader_iter():
-            if not grow:
-                writer.writerow(row)
+    with utils.openfile(gtf_fn, newline="") as fin, open(out_fn, "w", newline="") as f:
+        for i, line in enumerate(fin, start=1):
+            if not line.strip("\r\n"):
                 continue
+            if not line.endswith("\n"):
+                line += "\n"
+            if line.startswith("#"):
+                f.write(line)
+                continue
+
+            row = line.rstrip("\r\n").split("\t")
+            if len(row) != 9:
+                sys.exit(f"Invalid number of columns in GTF line {i}: {row}\n")
+            if row[6] not in ["+", "-"]:
+                sys.exit(f"Invalid strand in GTF line {i}: {row}\n")
 
             remove = False
-            if allow:
-                for key, value in grow.attributes.items():
-                    if key in allow and value not in allow[key]:
-                        remove = True
-                        break
+            for key, values in allow.items():
+                value = get_attribute(row[8], key, gp)
+                if value is not None and value not in values:
+                    remove = True
+                    break
 
             if not remove:
-                writer.writerow(row)
+                f.write(line)
             else:
                 n_filter += 1
     return n_filter
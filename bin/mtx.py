@@ -0,0 +1,99 @@
+"""
+Read MatrixMarket files written by STARsolo in large vectorized chunks.
+"""
+
+import numpy as np
+import pandas as pd
+import utils
+
+CHUNK_SIZE = 2**23
+
+
+def read_header(matrix_file):
+    """
+    Returns:
+        n_header_lines, (n_rows, n_cols, nnz), value dtype
+
+    >>> import tempfile, os
+    >>> fn = os.path.join(tempfile.mkdtemp(), "matrix.mtx")
+    >>> _ = open(fn, "w").write("%%MatrixMarket matrix coordinate integer general\\n%\\n3 2 2\\n1 1 5\\n3 2 1\\n")
+    >>> read_header(fn)
+    (3, (3, 2, 2), <class 'numpy.int64'>)
+    """
+    n = 0
+    dtype = np.int64
+    with utils.openfile(matrix_file) as f:
+        for line in f:
+            n += 1
+            if line.startswith("%%MatrixMarket"):
+                if "real" in line or "double" in line:
+                    dtype = np.float64
+            elif not line.startswith("%"):
+                shape = tuple(int(x) for x in line.split())
+                return n, shape, dtype
+    raise ValueError(f"{matrix_file} has no size line")
+
+
+def iter_mtx(matrix_file, chunksize=CHUNK_SIZE):
+    """
+    Yields:
+        0-based row index, 0-based col index and value arrays of each chunk
+    """
+    n_header, _shape, dtype = read_header(matrix_file)
+    with utils.openfile(matrix_file, "rb") as f:
+        yield from read_mtx_chunks(f, n_header, dtype, chunksize)
+
+
+def read_mtx_chunks(f, n_header, dtype, chunksize):
+    reader = pd.read_csv(
+        f,
+        sep=" ",
+        header=None,
+        skiprows=n_header,
+        names=["row", "col", "value"],
+        dtype={"row": np.int32, "col": np.int32, "value": dtype},
+        chunksize=chunksize,
+        engine="c",
+    )
+    with reader:
+        for df in reader:
+            yield df["row"].values - 1, df["col"].values - 1, df["value"].values
+
+
+class MtxSummary:
+    """
+    One pass summary of a gene (row) x cell (col) matrix.
+    Per-cell counts cover every column, so a raw matrix gives the UMI coverage of all barcodes;
+    per-gene counts only cover the columns in col_mask.
+
+    >>> import tempfile, os
+    >>> fn = os.path.join(tempfile.mkdtemp(), "matrix.mtx")
+    >>> _ = open(fn, "w").write("%%MatrixMarket matrix coordinate integer general\\n%\\n3 2 3\\n1 1 5\\n3 1 2\\n3 2 1\\n")
+    >>> s = MtxSummary(fn, chunksize=2)
+    >>> s.total_genes, s.cell_umis.tolist(), s.cell_genes.tolist(), s.gene_umis.tolist()
+    (2, [7, 1], [2, 1], [5, 0, 3])
+    >>> s = MtxSummary(fn, col_mask=np.array([False, True]))
+    >>> s.total_genes, s.cell_umis.tolist(), s.gene_umis.tolist()
+    (1, [7, 1], [0, 0, 1])
+    """
+
+    def __init__(self, matrix_file, chunksize=CHUNK_SIZE, col_mask=None):
+        """
+        Args:
+            col_mask: if set, only entries in columns where col_mask is True are counted in the per-gene counts
+        """
+        _n_header, (n_rows, n_cols, nnz), dtype = read_header(matrix_file)
+        self.nnz = nnz
+        self.cell_umis = np.zeros(n_cols, dtype=dtype)
+        self.cell_genes = np.zeros(n_cols, dtype=np.int64)
+        self.gene_umis = np.zeros(n_rows, dtype=dtype)
+        self.gene_cells = np.zeros(n_rows, dtype=np.int64)
+        for row, col, value in iter_mtx(matrix_file, chunksize):
+            self.cell_umis += np.bincount(col, weights=value, minlength=n_cols).astype(dtype)
+            self.cell_genes += np.bincount(col, minlength=n_cols)
+            if col_mask is not None:
+                keep = col_mask[col]
+                row, value = row[keep], value[keep]
+            self.gene_umis += np.bincount(row, weights=value, minlength=n_rows).astype(dtype)
+            self.gene_cells += np.bincount(row, minlength=n_rows)
+        self.total_genes = int(np.count_nonzero(self.gene_cells))
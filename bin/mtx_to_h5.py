@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+mtx_to_h5.py --matrix_dir {sample}.matrix/raw {sample}.matrix/filtered \
+    --out {sample}.raw_feature_bc_matrix.h5 {sample}.filtered_feature_bc_matrix.h5
+Convert STARsolo MatrixMarket directories, one at a time, into a chunked, compressed 10x Genomics HDF5 feature-barcode matrix
+(CSC, one column per barcode) with bounded memory.
+"""
+
+import argparse
+import os
+import sys
+
+import h5py
+import mtx
+import numpy as np
+import utils
+
+logger = utils.get_logger(__name__)
+
+FEATURE_FILE_NAME = "features.tsv.gz"
+BARCODE_FILE_NAME = "barcodes.tsv.gz"
+MATRIX_FILE_NAME = "matrix.mtx.gz"
+FEATURE_TYPE = "Gene Expression"
+# number of elements per hdf5 chunk
+H5_CHUNK_SIZE = 2**16
+# max number of matrix entries held in memory when the mtx is not sorted by column
+MAX_ENTRIES = 2**25
+
+
+class NotColumnSortedError(Exception):
+    pass
+
+
+def read_features(features_file):
+    """
+    Returns:
+        ids, names, feature types
+    """
+    ids, names, types = [], [], []
+    with utils.openfile(features_file) as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            ids.append(cols[0])
+            names.append(cols[1] if len(cols) > 1 else cols[0])
+            types.append(cols[2] if len(cols) > 2 else FEATURE_TYPE)
+    return ids, names, types
+
+
+def create_dataset(group, name, dtype):
+    return group.create_dataset(
+        name,
+        shape=(0,),
+        maxshape=(None,),
+        chunks=(H5_CHUNK_SIZE,),
+        dtype=dtype,
+        compression="gzip",
+        compression_opts=4,
+        shuffle=True,
+    )
+
+
+def append(dataset, values):
+    n = dataset.shape[0]
+    dataset.resize((n + len(values),))
+    dataset[n:] = values
+
+
+def write_sorted(matrix_file, n_cols, data, indices, chunksize):
+    """
+    One pass over a matrix sorted by column, as written by STARsolo.
+    Entries of the last column of each chunk are held back until the column is complete, so rows can be sorted.
+
+    Returns:
+        nnz of each column
+    Raises:
+        NotColumnSortedError
+    """
+    counts = np.zeros(n_cols, dtype=np.int64)
+    last_col = -1
+    pending = None
+    for row, col, value in mtx.iter_mtx(matrix_file, chunksize):
+        if not len(col):
+            continue
+        if col[0] < last_col or np.any(col[1:] < col[:-1]):
+            raise NotColumnSortedError
+        last_col = col[-1]
+        counts += np.bincount(col, minlength=n_cols)
+        if pending is not None:
+            row, col, value = (np.concatenate([x, y]) for x, y in zip(pending, (row, col, value)))
+        split = np.searchsorted(col, last_col)
+        pending = (row[split:], col[split:], value[split:])
+        order = np.lexsort((row[:split], col[:split]))
+        append(indices, row[:split][order])
+        append(data, value[:split][order])
+    if pending is not None:
+        row, col, value = pending
+        order = np.argsort(row, kind="stable")
+        append(indices, row[order])
+        append(data, value[order])
+    return counts
+
+
+def write_by_blocks(matrix_file, n_cols, data, indices, chunksize, max_entries=MAX_ENTRIES):
+    """
+    For matrices not sorted by column: count the entries of each column, then read the matrix once per block of
+    columns with at most max_entries entries, so memory stays bounded at the cost of more passes.
+
+    Returns:
+        nnz of each column
+    """
+    counts = np.zeros(n_cols, dtype=np.int64)
+    for _row, col, _value in mtx.iter_mtx(matrix_file, chunksize):
+        counts += np.bincount(col, minlength=n_cols)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    start = 0
+    while start < n_cols:
+        # at least one column per block
+        end = max(int(np.searchsorted(indptr, indptr[start] + max_entries, side="right")) - 1, start + 1)
+        end = min(end, n_cols)
+        block = [[], [], []]
+        for row, col, value in mtx.iter_mtx(matrix_file, chunksize):
+            mask = (col >= start) & (col < end)
+            for x, y in zip(block, (row, col, value)):
+                x.append(y[mask])
+        row, col, value = (np.concatenate(x) for x in block)
+        order = np.lexsort((row, col))
+        append(indices, row[order])
+        append(data, value[order])
+        start = end
+    return counts
+
+
+@utils.add_log
+def mtx_to_h5(matrix_dir, out, chunksize=mtx.CHUNK_SIZE):
+    """
+    Write the 10x h5 layout: /matrix/{barcodes, data, indices, indptr, shape, features/{id, name, feature_type, genome}}
+
+    >>> import tempfile, gzip
+    >>> d = tempfile.mkdtemp()
+    >>> with gzip.open(os.path.join(d, MATRIX_FILE_NAME), "wt") as f:
+    ...     _ = f.write("%%MatrixMarket matrix coordinate integer general\\n%\\n3 2 3\\n3 1 2\\n1 1 5\\n2 2 1\\n")
+    >>> with gzip.open(os.path.join(d, BARCODE_FILE_NAME), "wt") as f:
+    ...     _ = f.write("AAA\\nCCC\\n")
+    >>> with gzip.open(os.path.join(d, FEATURE_FILE_NAME), "wt") as f:
+    ...     _ = f.write("g1\\tG1\\ng2\\tG2\\ng3\\tG3\\n")
+    >>> out = os.path.join(d, "m.h5")
+    >>> mtx_to_h5(d, out, chunksize=2)
+    >>> with h5py.File(out) as f:
+    ...     m = f["matrix"]
+    ...     [m[x][:].tolist() for x in ("data", "indices", "indptr", "shape", "barcodes")]
+    [[5, 2, 1], [0, 2, 1], [0, 2, 3], [3, 2], [b'AAA', b'CCC']]
+    """
+    matrix_file = os.path.join(matrix_dir, MATRIX_FILE_NAME)
+    _n_header, (n_rows, n_cols, nnz), dtype = mtx.read_header(matrix_file)
+    barcodes = utils.read_one_col(os.path.join(matrix_dir, BARCODE_FILE_NAME))
+    ids, names, types = read_features(os.path.join(matrix_dir, FEATURE_FILE_NAME))
+    if len(barcodes) != n_cols or len(ids) != n_rows:
+        sys.exit(
+            f"Error: {matrix_file} is {n_rows} x {n_cols} but there are {len(ids)} features and {len(barcodes)} barcodes"
+        )
+
+    with h5py.File(out, "w") as f:
+        f.attrs["filetype"] = "matrix"
+        f.attrs["version"] = 2
+        group = f.create_group("matrix")
+        data_dtype = np.int32 if dtype == np.int64 else np.float32
+        data = create_dataset(group, "data", data_dtype)
+        indices = create_dataset(group, "indices", np.int64)
+        try:
+            counts = write_sorted(matrix_file, n_cols, data, indices, chunksize)
+        except NotColumnSortedError:
+            logger.info(f"{matrix_file} is not sorted by column. Writing by column blocks")
+            data.resize((0,))
+            indices.resize((0,))
+            counts = write_by_blocks(matrix_file, n_cols, data, indices, chunksize)
+        utils.add_rows(int(counts.sum()))
+        group.create_dataset("indptr", data=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        group.create_dataset("shape", data=np.array([n_rows, n_cols], dtype=np.int32))
+        group.create_dataset("barcodes", data=np.array(barcodes, dtype="S"), compression="gzip")
+        features = group.create_group("features")
+        features.create_dataset("id", data=np.array(ids, dtype="S"), compression="gzip")
+        features.create_dataset("name", data=np.array(names, dtype="S"), compression="gzip")
+        features.create_dataset("feature_type", data=np.array(types, dtype="S"), compression="gzip")
+        features.create_dataset("genome", data=np.array([""] * n_rows, dtype="S"), compression="gzip")
+        features.create_dataset("_all_tag_keys", data=np.array(["genome"], dtype="S"))
+    logger.info(f"{nnz} entries of {n_rows} features x {n_cols} barcodes written to {out}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--matrix_dir", required=True, nargs="+", help="directories with matrix.mtx.gz, barcodes and features"
+    )
+    parser.add_argument("--out", required=True, nargs="+", help="output h5 file of each matrix_dir")
+    parser.add_argument("--sample", help="sample name. Write resource usage to {sample}.scrna.mtx_to_h5.perf.json")
+    args = parser.parse_args()
+    if len(args.matrix_dir) != len(args.out):
+        parser.error("--matrix_dir and --out must have the same number of values")
+
+    for matrix_dir, out in zip(args.matrix_dir, args.out):
+        mtx_to_h5(matrix_dir, out)
+    if args.sample:
+        utils.write_perf(args.sample, "scrna", "mtx_to_h5")
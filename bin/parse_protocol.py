@@ -1,13 +1,27 @@
+import gzip
+import hashlib
 import itertools
 import json
+import math
 import os
 import re
 import sys
+import time
+import zlib
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import pyfastx
 import utils
 
+try:
+    import numpy as np
+except ImportError:
+    # Auto(batch=False) works without numpy
+    np = None
+
 logger = utils.get_logger(__name__)
 
 
@@ -76,6 +90,427 @@ def get_mismatch_dict(seq_list, n_mismatch=1):
     return mismatch_dict
 
 
+BASE_CODE = str.maketrans("ACGTN", "01234")
+AMBIGUOUS = -1
+# bump when the MismatchIndex file layout changes
+INDEX_CACHE_VERSION = 1
+# 3 bits per base and a leading 1 in 64 bits
+MAX_CODE_LEN = 21
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# max BGZF block size is 64KB
+BGZF_SEARCH_SIZE = 2 * 2**16
+# checked in order; the first matched protocol wins
+BARCODE_PROTOCOLS = ["GEXSCOPE-V2", "GEXSCOPE-V1"]
+# bytes hashed for the fastq fingerprint; also the max size of a BGZF block
+FINGERPRINT_SIZE = 2**16
+DETECTION_CACHE_FILE = "protocol_detection_cache.json"
+
+
+def encode_seq(seq):
+    """
+    pack seq into an int with 3 bits per base(A=0, C=1, G=2, T=3, N=4).
+    A leading 1 keeps sequences of different lengths apart.
+
+    Raises:
+        ValueError if seq contains other characters
+
+    >>> encode_seq("ACGTN")
+    33436
+    >>> encode_seq("ACGTN") == encode_seq("AACGTN")
+    False
+    """
+    return int("1" + seq.translate(BASE_CODE), 8)
+
+
+def get_mismatch_codes(seq, n_mismatch=1):
+    """
+    encode_seq of all mismatch <= n_mismatch seqs, computed from the code of seq instead of building strings.
+
+    >>> get_mismatch_codes("ACG") == {encode_seq(x) for x in findall_mismatch("ACG")}
+    True
+    >>> get_mismatch_codes("ACGT", 2) == {encode_seq(x) for x in findall_mismatch("ACGT", 2)}
+    True
+    """
+    code = encode_seq(seq)
+    seq_len = len(seq)
+    # change of the code when the base at each position is replaced by A, C, G, T or N
+    shifts = [3 * (seq_len - 1 - i) for i in range(seq_len)]
+    deltas = [[(base - (code >> shift & 7)) << shift for base in range(5)] for shift in shifts]
+    codes = set()
+    for locs in itertools.combinations(range(seq_len), min(n_mismatch, seq_len)):
+        for delta in itertools.product(*[deltas[loc] for loc in locs]):
+            codes.add(code + sum(delta))
+    return codes
+
+
+class MismatchIndex:
+    """
+    Compact replacement of get_mismatch_dict.
+    Keys are integer-encoded sequences stored in a sorted array; values are indices into seq_list.
+    A mismatch seq shared by more than one whitelist seq is ambiguous and is not corrected,
+    instead of silently keeping the last one.
+
+    >>> index = MismatchIndex(["AACGTGAT", "AAACATCG"])
+    >>> index["AACGTGAA"]
+    'AACGTGAT'
+    >>> "AACGTGAA" in index, "TTTTTTTT" in index
+    (True, False)
+    >>> index = MismatchIndex(["AAA", "AAT"])
+    >>> index["AAA"], index.n_ambiguous
+    ('AAA', 3)
+    >>> "AAG" in index
+    False
+    """
+
+    def __init__(self, seq_list, n_mismatch=1):
+        self.seqs = [x.strip() for x in seq_list if x.strip()]
+        self.n_mismatch = n_mismatch
+        # whitelist seqs always map to themselves
+        exact = {encode_seq(seq): index for index, seq in enumerate(self.seqs)}
+        if np is not None and max(map(len, self.seqs), default=0) <= MAX_CODE_LEN:
+            self.keys, self.values = self.sort_arrays(exact)
+        else:
+            self.keys, self.values = self.sort_packed(exact)
+        self.n_ambiguous = self.values.count(AMBIGUOUS)
+
+    def sort_arrays(self, exact):
+        """
+        sort the variant codes of all seqs with numpy. Variants next to an equal code are ambiguous.
+
+        Returns:
+            keys: array("Q"), values: array("i")
+        """
+        codes, indices = array("Q"), array("i")
+        for index, seq in enumerate(self.seqs):
+            seq_codes = get_mismatch_codes(seq, self.n_mismatch)
+            codes.extend(seq_codes)
+            indices.extend(itertools.repeat(index, len(seq_codes)))
+        codes = np.frombuffer(codes, dtype=np.uint64)
+        order = np.argsort(codes, kind="stable")
+        codes = codes[order]
+        indices = np.frombuffer(indices, dtype=np.int32)[order]
+        del order
+        start = np.ones(len(codes), dtype=bool)
+        start[1:] = codes[1:] != codes[:-1]
+        n_variant = np.diff(np.flatnonzero(start), append=len(codes))
+        keys, values = codes[start], indices[start]
+        del codes, indices, start
+        values[n_variant > 1] = AMBIGUOUS
+        if exact:
+            values[np.searchsorted(keys, np.array(list(exact), dtype=np.uint64))] = list(exact.values())
+        return array("Q", keys.tobytes()), array("i", values.tobytes())
+
+    def sort_packed(self, exact):
+        """
+        pure Python sort_arrays for seqs longer than MAX_CODE_LEN or without numpy.
+
+        Returns:
+            keys: array("Q"), or list if the codes do not fit in 64 bits; values: array("i")
+        """
+        # code << 32 | index: sorting puts the variants of the same code next to each other
+        packed = []
+        for index, seq in enumerate(self.seqs):
+            packed.extend(code << 32 | index for code in get_mismatch_codes(seq, self.n_mismatch))
+        packed.sort()
+        keys, values = [], array("i")
+        for item in packed:
+            code = item >> 32
+            if keys and keys[-1] == code:
+                if code not in exact:
+                    values[-1] = AMBIGUOUS
+            else:
+                keys.append(code)
+                values.append(exact.get(code, item & 0xFFFFFFFF))
+        del packed
+        try:
+            keys = array("Q", keys)
+        except OverflowError:
+            pass
+        return keys, values
+
+    def get_index(self, seq):
+        """return index of the corrected seq in self.seqs; None if not found or ambiguous"""
+        try:
+            code = encode_seq(seq)
+        except ValueError:
+            return None
+        i = bisect_left(self.keys, code)
+        if i == len(self.keys) or self.keys[i] != code:
+            return None
+        index = self.values[i]
+        if index == AMBIGUOUS:
+            return None
+        return index
+
+    def __contains__(self, seq):
+        return self.get_index(seq) is not None
+
+    def __getitem__(self, seq):
+        index = self.get_index(seq)
+        if index is None:
+            raise KeyError(seq)
+        return self.seqs[index]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_index_array(self, matrix):
+        """
+        vectorized get_index for the rows of a uint8 matrix from seqs_to_matrix.
+
+        Returns:
+            numpy int array; -1 if not found or ambiguous
+
+        >>> index = MismatchIndex(["AACGTGAT", "AAACATCG"])
+        >>> index.get_index_array(seqs_to_matrix(["AACGTGAA", "AAACATCG", "AAAAAAAA", "AACG"], 8)).tolist()
+        [0, 1, -1, -1]
+        >>> index = MismatchIndex(["A" * 24, "C" * 24])
+        >>> index.get_index_array(seqs_to_matrix(["A" * 23 + "T", "G" * 24], 24)).tolist()
+        [0, -1]
+        """
+        if matrix.shape[1] > MAX_CODE_LEN or not isinstance(self.keys, array):
+            # codes do not fit in uint64: look up the rows one by one
+            indices = [self.get_index(row.tobytes().decode()) for row in matrix]
+            return np.array([AMBIGUOUS if x is None else x for x in indices], dtype=np.int32)
+        codes = encode_matrix(matrix, slice(None))
+        keys = np.frombuffer(self.keys, dtype=np.uint64)
+        values = np.frombuffer(self.values, dtype=np.int32)
+        pos = np.searchsorted(keys, codes)
+        pos[pos == len(keys)] = 0
+        found = (keys[pos] == codes) & (codes != INVALID_CODE)
+        return np.where(found, values[pos], AMBIGUOUS)
+
+    def save(self, fn):
+        """write keys and values as raw arrays: n_keys, keys, values"""
+        with open(fn, "wb") as f:
+            array("Q", [len(self.keys)]).tofile(f)
+            self.keys.tofile(f)
+            self.values.tofile(f)
+
+    @classmethod
+    def load(cls, fn, seq_list, n_mismatch=1):
+        """
+        load index saved by save(). seq_list must be the same whitelist used to build it.
+
+        >>> import tempfile
+        >>> index = MismatchIndex(["AACGTGAT", "AAACATCG"])
+        >>> fn = tempfile.mktemp()
+        >>> index.save(fn)
+        >>> loaded = MismatchIndex.load(fn, ["AACGTGAT", "AAACATCG"])
+        >>> loaded["AACGTGAA"], len(loaded) == len(index)
+        ('AACGTGAT', True)
+        """
+        index = cls.__new__(cls)
+        index.seqs = [x.strip() for x in seq_list if x.strip()]
+        index.n_mismatch = n_mismatch
+        with open(fn, "rb") as f:
+            n_keys = array("Q")
+            n_keys.fromfile(f, 1)
+            index.keys = array("Q")
+            index.keys.fromfile(f, n_keys[0])
+            index.values = array("i")
+            index.values.fromfile(f, n_keys[0])
+        index.n_ambiguous = index.values.count(AMBIGUOUS)
+        return index
+
+
+def hamming_distance(seq1, seq2, max_dist):
+    """
+    Returns:
+        hamming distance; max_dist + 1 once it exceeds max_dist
+
+    >>> hamming_distance("AAAA", "ATAT", 2)
+    2
+    >>> hamming_distance("AAAA", "TTTT", 2)
+    3
+    """
+    dist = 0
+    for a, b in zip(seq1, seq2):
+        if a != b:
+            dist += 1
+            if dist > max_dist:
+                break
+    return dist
+
+
+def get_peq(seq):
+    """bit mask of the positions of each base in seq"""
+    peq = {}
+    for i, c in enumerate(seq):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    return peq
+
+
+def edit_distance(seq1, seq2, max_dist, peq=None):
+    """
+    Levenshtein distance with Myers' bit-parallel algorithm.
+
+    Args:
+        peq: get_peq(seq1), to reuse it across many seq2
+    Returns:
+        edit distance; max_dist + 1 if it exceeds max_dist
+
+    >>> edit_distance("ACGTACGT", "CGTACGTA", 2)
+    2
+    >>> edit_distance("ACGTACGT", "ACGTACGT", 2)
+    0
+    >>> edit_distance("ACGTACGT", "TTTTTTTT", 2)
+    3
+    """
+    if abs(len(seq1) - len(seq2)) > max_dist:
+        return max_dist + 1
+    if peq is None:
+        peq = get_peq(seq1)
+    mask = (1 << len(seq1)) - 1
+    high = 1 << (len(seq1) - 1)
+    pv, mv, dist = mask, 0, len(seq1)
+    for c in seq2:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            dist += 1
+        elif mh & high:
+            dist -= 1
+        ph = ((ph << 1) | 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+    return min(dist, max_dist + 1)
+
+
+class PigeonholeIndex:
+    """
+    Barcode correction for n_mismatch >= 2 with memory linear in the whitelist size.
+    Each barcode is split into n_mismatch + 1 parts; a query within n_mismatch errors shares at least one part exactly
+    (at most n_mismatch bases away with edit distance), so only barcodes sharing a part are compared.
+    The unique closest barcode is returned; ties are ambiguous and not corrected.
+    Same interface as MismatchIndex.
+
+    >>> index = PigeonholeIndex(["AACGTGATCG", "AAACATCGTT", "GGGGCCCCTT"])
+    >>> index["AACGTGATCG"], index["TTCGTGATCG"]
+    ('AACGTGATCG', 'AACGTGATCG')
+    >>> "TTTGTGATCG" in index
+    False
+    >>> index = PigeonholeIndex(["AACGTGATCG", "AAACATCGTT"], edit_distance=True)
+    >>> index["ACGTGATCGA"]
+    'AACGTGATCG'
+    >>> index = PigeonholeIndex(["AAAAAAAA", "AAAAAATT"])
+    >>> "AAAAAATA" in index
+    False
+    """
+
+    def __init__(self, seq_list, n_mismatch=2, edit_distance=False):
+        self.seqs = [x.strip() for x in seq_list if x.strip()]
+        self.n_mismatch = n_mismatch
+        self.edit_distance = edit_distance
+        self.n_ambiguous = 0
+        self.parts = {}
+        # part_index[(length, i)]: {part seq: array of indices into self.seqs}
+        self.part_index = defaultdict(dict)
+        for index, seq in enumerate(self.seqs):
+            for i, part_slice in enumerate(self.get_parts(len(seq))):
+                part_dict = self.part_index[(len(seq), i)]
+                part_dict.setdefault(seq[part_slice], array("I")).append(index)
+        self.part_index = dict(self.part_index)
+        self.exact = {seq: index for index, seq in enumerate(self.seqs)}
+
+    def get_parts(self, length):
+        if length not in self.parts:
+            n_part = self.n_mismatch + 1
+            bounds = [length * i // n_part for i in range(n_part + 1)]
+            self.parts[length] = [slice(start, stop) for start, stop in zip(bounds, bounds[1:])]
+        return self.parts[length]
+
+    def get_candidates(self, seq):
+        candidates = set()
+        shifts = range(-self.n_mismatch, self.n_mismatch + 1) if self.edit_distance else [0]
+        lengths = {len(seq)}
+        if self.edit_distance:
+            lengths = {length for length, _i in self.part_index if abs(length - len(seq)) <= self.n_mismatch}
+        for length in lengths:
+            for i, part_slice in enumerate(self.get_parts(length)):
+                part_dict = self.part_index.get((length, i))
+                if not part_dict:
+                    continue
+                # nothing before the first part can shift it
+                for shift in shifts if i else [0]:
+                    start = part_slice.start + shift
+                    if start < 0:
+                        continue
+                    candidates.update(part_dict.get(seq[start : part_slice.stop + shift], ()))
+        return candidates
+
+    def get_index(self, seq):
+        """return index of the corrected seq in self.seqs; None if not found or ambiguous"""
+        if seq in self.exact:
+            return self.exact[seq]
+        peq = get_peq(seq) if self.edit_distance else None
+        best, best_dist, n_best = None, self.n_mismatch + 1, 0
+        for index in self.get_candidates(seq):
+            target = self.seqs[index]
+            if self.edit_distance:
+                dist = edit_distance(seq, target, self.n_mismatch, peq)
+            elif len(target) == len(seq):
+                dist = hamming_distance(seq, target, self.n_mismatch)
+            else:
+                continue
+            if dist < best_dist:
+                best, best_dist, n_best = index, dist, 1
+            elif dist == best_dist:
+                n_best += 1
+        if n_best != 1:
+            return None
+        return best
+
+    def __contains__(self, seq):
+        return self.get_index(seq) is not None
+
+    def __getitem__(self, seq):
+        index = self.get_index(seq)
+        if index is None:
+            raise KeyError(seq)
+        return self.seqs[index]
+
+    def __len__(self):
+        return len(self.seqs)
+
+
+INVALID_CODE = 0
+
+
+def seqs_to_matrix(seqs, width):
+    """
+    fixed-width uint8 matrix of seqs. Longer seqs are truncated, shorter seqs are padded with '.'
+
+    >>> seqs_to_matrix(["ACG", "A"], 2).tobytes()
+    b'ACA.'
+    """
+    buf = "".join([seq[:width].ljust(width, ".") for seq in seqs]).encode()
+    return np.frombuffer(buf, dtype=np.uint8).reshape(len(seqs), width)
+
+
+def encode_matrix(matrix, sub_slice):
+    """
+    vectorized encode_seq of matrix[:, sub_slice]. Rows with other characters get INVALID_CODE.
+
+    >>> matrix = seqs_to_matrix(["ACGTN", "ACGT.", "ACG"], 5)
+    >>> encode_matrix(matrix, slice(0, 5)).tolist() == [encode_seq("ACGTN"), INVALID_CODE, INVALID_CODE]
+    True
+    """
+    lookup = np.full(256, 7, dtype=np.uint64)
+    for base, code in zip(b"ACGTN", range(5)):
+        lookup[base] = code
+    bases = lookup[matrix[:, sub_slice]]
+    codes = np.ones(len(matrix), dtype=np.uint64)
+    for i in range(bases.shape[1]):
+        codes = (codes << np.uint64(3)) | bases[:, i]
+    codes[(bases == 7).any(axis=1)] = INVALID_CODE
+    return codes
+
+
 def parse_pattern(pattern, allowed="CLUNT"):
     """
     >>> pattern_dict = parse_pattern("C8L16C8L16C8L1U12T18")
@@ -101,21 +536,79 @@ def parse_pattern(pattern, allowed="CLUNT"):
     return pattern_dict
 
 
-def get_raw_mismatch(files: list, n_mismatch: int):
+def get_index_cache_file(whitelist_file, barcodes, n_mismatch, cache_dir=None):
+    """
+    cache file name is keyed by the content hash of the whitelist, so an edited whitelist never hits a stale cache.
+
+    >>> fn = get_index_cache_file("assets/whitelist/GEXSCOPE-V2/bc1.txt", ["AAA"], 1)
+    >>> fn.startswith("assets/whitelist/GEXSCOPE-V2/.bc1.txt.mm1.")
+    True
+    >>> fn == get_index_cache_file("assets/whitelist/GEXSCOPE-V2/bc1.txt", ["AAT"], 1)
+    False
+    """
+    md5 = hashlib.md5()
+    md5.update(f"v{INDEX_CACHE_VERSION}_{sys.byteorder}_{n_mismatch}\n".encode())
+    md5.update("\n".join(barcodes).encode())
+    folder, base = os.path.split(whitelist_file)
+    if cache_dir:
+        folder = cache_dir
+    return os.path.join(folder, f".{base}.mm{n_mismatch}.{md5.hexdigest()[:16]}.idx")
+
+
+def get_mismatch_index(whitelist_file, barcodes, n_mismatch, cache_dir=None, edit_distance=False):
+    """
+    load MismatchIndex from the on-disk cache, or build it and write the cache.
+    Failure to write the cache (e.g. read-only assets) only logs a warning.
+    n_mismatch >= 2 or edit_distance uses PigeonholeIndex, which is cheap to build and not cached.
+    """
+    if n_mismatch >= 2 or edit_distance:
+        return PigeonholeIndex(barcodes, n_mismatch, edit_distance)
+
+    cache_file = get_index_cache_file(whitelist_file, barcodes, n_mismatch, cache_dir)
+    if os.path.exists(cache_file):
+        try:
+            mismatch_index = MismatchIndex.load(cache_file, barcodes, n_mismatch)
+            logger.info(f"mismatch index cache hit: {cache_file}")
+            return mismatch_index
+        except (OSError, EOFError) as e:
+            logger.warning(f"invalid mismatch index cache {cache_file}: {e}")
+
+    start = time.time()
+    mismatch_index = MismatchIndex(barcodes, n_mismatch)
+    logger.info(f"mismatch index cache miss: {whitelist_file}. build time: {time.time() - start:.3f}s")
+    if isinstance(mismatch_index.keys, array):
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        try:
+            mismatch_index.save(tmp_file)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            logger.warning(f"can not write mismatch index cache {cache_file}: {e}")
+    return mismatch_index
+
+
+def get_raw_mismatch(files: list, n_mismatch: int, cache_dir=None, edit_distance=False):
     """
     Args:
         files: whitelist file paths
         n_mismatch: allowed number of mismatch bases
+        cache_dir: folder of the mismatch index cache. Default: beside the whitelist file
+        edit_distance: allow indels as well as mismatches
     Returns:
         raw_list
-        mismatch_list
+        mismatch_list: list of MismatchIndex, or PigeonholeIndex if n_mismatch >= 2 or edit_distance
     """
     raw_list, mismatch_list = [], []
+    file_index = {}
     for f in files:
-        barcodes = utils.read_one_col(f)
-        raw_list.append(set(barcodes))
-        barcode_mismatch_dict = get_mismatch_dict(barcodes, n_mismatch)
-        mismatch_list.append(barcode_mismatch_dict)
+        if f not in file_index:
+            barcodes = utils.read_one_col(f)
+            mismatch_index = get_mismatch_index(f, barcodes, n_mismatch, cache_dir, edit_distance)
+            if mismatch_index.n_ambiguous:
+                logger.info(f"{f}: {mismatch_index.n_ambiguous} ambiguous mismatch sequences are not corrected")
+            file_index[f] = (set(barcodes), mismatch_index)
+        raw_set, mismatch_index = file_index[f]
+        raw_list.append(raw_set)
+        mismatch_list.append(mismatch_index)
 
     return raw_list, mismatch_list
 
@@ -137,6 +630,14 @@ def check_seq_mismatch(seq_list, raw_list, mismatch_list):
     >>> seq_list = ['AAA', 'AAA', 'AAA']
     >>> check_seq_mismatch(seq_list, correct_set_list, mismatch_dict_list)
     (True, False, 'AAA_AAA_AAA')
+
+    >>> mismatch_index_list = [MismatchIndex(['AAA'])] * 3
+    >>> check_seq_mismatch(['ATA', 'AAT', 'TTT'], correct_set_list, mismatch_index_list)
+    (False, True, '')
+
+    >>> pigeonhole_list = [PigeonholeIndex(['AAAAAAAAA'], 2)] * 3
+    >>> check_seq_mismatch(['AATAAATAA', 'AAAAAAAAA', 'AAAAAAAAA'], [{'AAAAAAAAA'}] * 3, pigeonhole_list)
+    (True, True, 'AAAAAAAAA_AAAAAAAAA_AAAAAAAAA')
     """
     valid = True
     corrected = False
@@ -155,6 +656,93 @@ def check_seq_mismatch(seq_list, raw_list, mismatch_list):
     return valid, corrected, "_".join(res)
 
 
+class LinkerMatcher:
+    """
+    Locate linkers within max_shift bases of their pattern positions, to rescue reads with small indels.
+    Each linker is found by looking up k-mers of the read in a precomputed {kmer: offsets in linker} index.
+
+    >>> pattern_dict = parse_pattern("C9L16C9L16C9L1U12")
+    >>> matcher = LinkerMatcher(pattern_dict, ["assets/whitelist/GEXSCOPE-V2/linker1.txt", "assets/whitelist/GEXSCOPE-V2/linker2.txt"])
+    >>> seq = "TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCTAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"
+    >>> matcher.find_shifts(seq)
+    (0, 0, 0)
+    >>> matcher.find_shifts("A" + seq)
+    (1, 1, 1)
+    >>> shifts = matcher.find_shifts(seq[:20] + seq[21:])
+    >>> shifts
+    (0, -1, -1)
+    >>> [(seq[:20] + seq[21:])[x] for x in matcher.shift_slices(pattern_dict["C"], shifts)]
+    ['TCGACTGTC', 'TTCTAGGAT', 'TGCACGAGA']
+    >>> matcher.find_shifts("A" * 60) is None
+    True
+    """
+
+    def __init__(self, pattern_dict, linker_files, max_shift=2, k=8):
+        self.linker_slices = pattern_dict["L"][: len(linker_files)]
+        self.k = k
+        self.kmer_index = []
+        for f in linker_files:
+            index = defaultdict(set)
+            for linker in utils.read_one_col(f):
+                for pos in range(len(linker) - k + 1):
+                    index[linker[pos : pos + k]].add(pos)
+            self.kmer_index.append(dict(index))
+        # try small shifts first
+        self.deltas = sorted(range(-max_shift, max_shift + 1), key=abs)
+
+    def search(self, seq, start, index, probe):
+        """Returns: delta of the linker k-mer at probe; None if not found"""
+        for delta in self.deltas:
+            pos = start + delta + probe
+            if pos >= 0 and probe in index.get(seq[pos : pos + self.k], ()):
+                return delta
+        return None
+
+    def find_shifts(self, seq):
+        """
+        Returns:
+            tuple of the shift of the first linker start, then the shift of each linker end, relative to the pattern.
+            None if any linker is not found.
+        """
+        starts, ends = [], []
+        cum = 0
+        for linker_slice, index in zip(self.linker_slices, self.kmer_index):
+            start = linker_slice.start + cum
+            start_delta = self.search(seq, start, index, 0)
+            end_delta = self.search(seq, start, index, linker_slice.stop - linker_slice.start - self.k)
+            if start_delta is None and end_delta is None:
+                return None
+            starts.append(None if start_delta is None else cum + start_delta)
+            ends.append(None if end_delta is None else cum + end_delta)
+            cum = ends[-1] if ends[-1] is not None else starts[-1]
+        # an indel inside the end k-mer hides the linker end; the next linker start is the closest anchor
+        for i, end in enumerate(ends):
+            if end is None:
+                next_start = starts[i + 1] if i + 1 < len(starts) else None
+                ends[i] = next_start if next_start is not None else starts[i]
+        # an indel inside the start k-mer of the first linker does not move the first segment
+        first = starts[0] if starts[0] is not None else 0
+        return (first, *ends)
+
+    def shift_slices(self, sub_pattern, shifts):
+        """
+        Segments before the first linker follow the first linker start; other segments follow the nearest upstream linker end.
+
+        Returns:
+            shifted slices; None if any slice starts before the read
+        """
+        res = []
+        for sub_slice in sub_pattern:
+            shift = shifts[0]
+            for linker_slice, linker_shift in zip(self.linker_slices, shifts[1:]):
+                if sub_slice.start >= linker_slice.stop:
+                    shift = linker_shift
+            if sub_slice.start + shift < 0:
+                return None
+            res.append(slice(sub_slice.start + shift, sub_slice.stop + shift))
+        return res
+
+
 def get_protocol_dict(assets_dir):
     """
     Return:
@@ -180,6 +768,334 @@ def get_protocol_dict(assets_dir):
     return protocol_dict
 
 
+def sprt(n_success, n_failure, p0, p1, alpha=1e-4, beta=1e-4):
+    """
+    Wald's sequential probability ratio test of H0: p=p0 against H1: p=p1 (p1 > p0).
+
+    Returns:
+        "H1", "H0" or None if more observations are needed
+
+    >>> sprt(30, 0, 0.5, 0.9)
+    'H1'
+    >>> sprt(3, 0, 0.5, 0.9) is None
+    True
+    >>> sprt(5, 30, 0.5, 0.9)
+    'H0'
+    """
+    llr = n_success * math.log(p1 / p0) + n_failure * math.log((1 - p1) / (1 - p0))
+    if llr >= math.log((1 - beta) / alpha):
+        return "H1"
+    if llr <= math.log(beta / (1 - alpha)):
+        return "H0"
+    return None
+
+
+def is_certain(results, n, min_read=1000):
+    """
+    True if the top protocol is certain to beat the runner-up, and its read percent is certain to be
+    on one side of the 0.1 failure threshold of check_fq_result:
+    above it if p=0.2 is accepted against p=0.1, or below it if p=0.05 is accepted against p=0.1.
+    Percents between the bracketing values need more reads.
+
+    >>> is_certain({"GEXSCOPE-V2": 900, "GEXSCOPE-MicroBead": 5}, 1000)
+    True
+    >>> is_certain({"GEXSCOPE-V2": 520, "GEXSCOPE-V1": 480}, 1000)
+    False
+    >>> is_certain({"GEXSCOPE-V2": 90}, 100)
+    False
+
+    near the threshold
+
+    >>> [is_certain({"GEXSCOPE-V2": x}, 1000) for x in (30, 100, 150, 200)]
+    [True, False, False, True]
+    """
+    if n < min_read or not results:
+        return False
+    counts = sorted(results.values(), reverse=True) + [0]
+    top, second = counts[0], counts[1]
+    if sprt(top, second, 0.5, 0.9) != "H1":
+        return False
+    return sprt(top, n - top, 0.1, 0.2) == "H1" or sprt(top, n - top, 0.05, 0.1) == "H0"
+
+
+def is_bgzf(fn):
+    """True if fn starts with a BGZF block header"""
+    with open(fn, "rb") as f:
+        header = f.read(18)
+    return header[:4] == BGZF_MAGIC and header[12:14] == b"BC"
+
+
+def find_bgzf_block(fh, offset, end):
+    """
+    Returns:
+        start offset of the first valid BGZF block in [offset, end), or None
+    """
+    fh.seek(offset)
+    buf = fh.read(min(end, offset + BGZF_SEARCH_SIZE) - offset)
+    i = buf.find(BGZF_MAGIC)
+    while i != -1:
+        if buf[i + 12 : i + 14] == b"BC":
+            fh.seek(offset + i)
+            try:
+                gzip.GzipFile(fileobj=fh).read(1)
+                return offset + i
+            except (OSError, EOFError, zlib.error):
+                pass
+        i = buf.find(BGZF_MAGIC, i + 1)
+    return None
+
+
+def iter_region_seqs(fh, stream, end):
+    """
+    Yield read seqs from stream, a binary line stream opened somewhere inside a fastq file.
+    Lines before the first complete record are skipped. Stop when fh passes end.
+
+    >>> import io
+    >>> fh = io.BytesIO(b"TTTT\\n+\\nFFFF\\n@r1\\nACGT\\n+\\nFFFF\\n@r2\\nGG\\n+\\nFF\\n")
+    >>> list(iter_region_seqs(fh, fh, 100))
+    ['ACGT', 'GG']
+    """
+    lines = []
+    for line in stream:
+        lines.append(line)
+        if len(lines) < 4:
+            continue
+        if lines[0][:1] == b"@" and lines[2][:1] == b"+" and len(lines[1]) == len(lines[3]):
+            yield lines[1].rstrip().decode()
+            lines = []
+            if fh.tell() > end:
+                return
+        else:
+            lines.pop(0)
+
+
+def iter_spread_seqs(fq, n_region=10):
+    """
+    Yield read seqs round-robin from n_region offsets spread across the fastq file.
+    - BGZF or plain text: seek into the file
+    - other compressed files: can not seek. Stream from the head of the file.
+    Compression is recognized by magic bytes, not by the file name.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("wb", suffix=".fq") as f:
+    ...     _ = f.write(gzip.compress(b"@r1\\nACGT\\n+\\nFFFF\\n@r2\\nGG\\n+\\nFF\\n"))
+    ...     f.flush()
+    ...     list(iter_spread_seqs(f.name))
+    ['ACGT', 'GG']
+    """
+    bgzf = is_bgzf(fq)
+    if not bgzf and utils.get_compression(fq, "rb"):
+        logger.info(f"{fq} is not BGZF compressed. Sample reads from the head of the file.")
+        for _name, seq, _qual in pyfastx.Fastx(fq):
+            yield seq
+        return
+
+    size = os.path.getsize(fq)
+    offsets = [size * i // n_region for i in range(n_region)] + [size]
+    regions = []
+    for start, end in zip(offsets, offsets[1:]):
+        fh = open(fq, "rb")
+        if bgzf:
+            block_start = find_bgzf_block(fh, start, end)
+            if block_start is None:
+                fh.close()
+                continue
+            fh.seek(block_start)
+            stream = gzip.GzipFile(fileobj=fh)
+        else:
+            fh.seek(start)
+            stream = fh
+        regions.append((fh, iter_region_seqs(fh, stream, end)))
+
+    try:
+        while regions:
+            for fh, region in list(regions):
+                seq = next(region, None)
+                if seq is None:
+                    fh.close()
+                    regions.remove((fh, region))
+                else:
+                    yield seq
+    finally:
+        for fh, _region in regions:
+            fh.close()
+
+
+def get_fastq_fingerprint(fq):
+    """
+    Cheap fingerprint of a fastq file: real path, size, mtime and md5 of the first compressed block (64 KB),
+    so that detection results can be reused without reading the fastq file.
+    """
+    real_path = os.path.realpath(fq)
+    stat = os.stat(real_path)
+    with open(real_path, "rb") as f:
+        head_md5 = hashlib.md5(f.read(FINGERPRINT_SIZE)).hexdigest()
+    return {"path": real_path, "size": stat.st_size, "mtime": stat.st_mtime, "head_md5": head_md5}
+
+
+def estimate_read_count(fq, n_sample=1000):
+    """
+    Estimate the number of reads from the compressed bytes consumed by the first n_sample reads.
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile("wb", suffix=".fq.gz") as f:
+    ...     _ = f.write(gzip.compress(b"@r\\nACGT\\n+\\nFFFF\\n" * 10))
+    ...     f.flush()
+    ...     estimate_read_count(f.name)
+    10
+    """
+    size = os.path.getsize(fq)
+    with open(fq, "rb") as f:
+        gz = f.read(2) == b"\x1f\x8b"
+        f.seek(0)
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if gz else None
+        n_line = consumed = 0
+        while n_line < n_sample * 4:
+            buf = f.read(FINGERPRINT_SIZE)
+            if not buf:
+                break
+            consumed += len(buf)
+            if decompressor:
+                data = decompressor.decompress(buf)
+                # concatenated gzip members, e.g. BGZF blocks
+                while decompressor.eof and decompressor.unused_data:
+                    unused = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    data += decompressor.decompress(unused)
+            else:
+                data = buf
+            n_line += data.count(b"\n")
+    if n_line < 4:
+        return 0
+    if consumed >= size:
+        return n_line // 4
+    return int(size / (consumed / (n_line / 4)))
+
+
+def get_assets_md5(protocol_dict, assets_dir):
+    """
+    md5 of protocols.json and the whitelist and linker files of every protocol
+
+    >>> get_assets_md5(get_protocol_dict("assets/"), "assets/") == get_assets_md5(get_protocol_dict("assets/"), "assets")
+    True
+    """
+    files = [os.path.join(assets_dir, "protocols.json")]
+    for protocol in sorted(protocol_dict):
+        files += protocol_dict[protocol].get("bc", []) + protocol_dict[protocol].get("linker", [])
+    md5 = hashlib.md5()
+    for fn in files:
+        with open(fn, "rb") as f:
+            md5.update(f.read())
+    return md5.hexdigest()
+
+
+class DetectionCache:
+    """
+    Protocol detection results keyed by fastq fingerprint and detection settings, in a json file.
+    The least recently used entries are evicted once there are more than max_entries.
+
+    >>> import tempfile
+    >>> v1, v2 = "assets/whitelist/GEXSCOPE-V1/bc.txt", "assets/protocols.json"
+    >>> with tempfile.TemporaryDirectory() as cache_dir:
+    ...     cache = DetectionCache(cache_dir, max_entries=2)
+    ...     cache.set(v1, {"protocol": "GEXSCOPE-V1"})
+    ...     cache.set(v2, {"protocol": "GEXSCOPE-V2"})
+    ...     cache.save()
+    ...     # a hit is saved, so v2 is the least recently used entry
+    ...     cache = DetectionCache(cache_dir, max_entries=2)
+    ...     _ = cache.get(v1)
+    ...     cache.save()
+    ...     cache = DetectionCache(cache_dir, max_entries=2)
+    ...     cache.set("assets/whitelist/GEXSCOPE-V1/linker1.txt", {"protocol": "GEXSCOPE-V1"})
+    ...     cache.save()
+    ...     cache = DetectionCache(cache_dir)
+    ...     hits = cache.get(v1)["protocol"], cache.get(v2)
+    ...     other_settings = DetectionCache(cache_dir, settings={"max_read": 100}).get(v1)
+    >>> hits, other_settings
+    (('GEXSCOPE-V1', None), None)
+    """
+
+    def __init__(self, cache_dir, max_entries=1000, settings=None):
+        """
+        Args:
+            settings: detection settings and assets md5. Results detected with other settings are not reused.
+        """
+        self.cache_file = os.path.join(cache_dir, DETECTION_CACHE_FILE)
+        self.max_entries = max_entries
+        self.settings = settings or {}
+        self.entries = self.load()
+        # True if entries were added or used since the last save
+        self.changed = False
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"invalid protocol detection cache {self.cache_file}: {e}")
+            return {}
+
+    def get_key(self, fingerprint):
+        key = {"fingerprint": fingerprint, "settings": self.settings}
+        return hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, fq):
+        """
+        Returns:
+            cached result of fq, or None
+        """
+        entry = self.entries.get(self.get_key(get_fastq_fingerprint(fq)))
+        if entry is None:
+            return None
+        entry["last_used"] = time.time()
+        self.changed = True
+        return entry["result"]
+
+    def set(self, fq, result):
+        fingerprint = get_fastq_fingerprint(fq)
+        self.entries[self.get_key(fingerprint)] = {
+            "fingerprint": fingerprint,
+            "result": result,
+            "last_used": time.time(),
+        }
+        self.changed = True
+
+    def save(self):
+        """merge with entries written by other samples since load, evict, then write atomically"""
+        entries = self.load()
+        for key, entry in self.entries.items():
+            if key not in entries or entries[key]["last_used"] < entry["last_used"]:
+                entries[key] = entry
+        if len(entries) > self.max_entries:
+            keep = sorted(entries, key=lambda x: entries[x]["last_used"], reverse=True)[: self.max_entries]
+            entries = {key: entries[key] for key in keep}
+        self.entries = entries
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file) or ".", exist_ok=True)
+            utils.write_json(entries, tmp_file)
+            os.replace(tmp_file, self.cache_file)
+            self.changed = False
+        except OSError as e:
+            logger.warning(f"can not write protocol detection cache {self.cache_file}: {e}")
+
+
+# set in each worker by init_detect_worker
+_detect_runner = None
+
+
+def init_detect_worker(runner):
+    global _detect_runner
+    _detect_runner = runner
+
+
+def detect_fq(fq1):
+    """Auto.get_fq_result in a worker"""
+    return _detect_runner.get_fq_result(fq1)
+
+
 class Auto:
     """
     Auto detect singleron protocols from R1-read
@@ -188,10 +1104,36 @@ class Auto:
     GEXSCOPE-V2
     """
 
-    def __init__(self, fq1_list, sample, assets_dir="assets/", max_read=10000):
+    def __init__(
+        self,
+        fq1_list,
+        sample,
+        assets_dir="assets/",
+        max_read=100000,
+        cache_dir=None,
+        batch=True,
+        threads=1,
+        early_stop=False,
+        chunk_size=1000,
+        sampling="spread",
+        detection_cache_dir=None,
+        force_detect=False,
+        detection_cache_size=1000,
+    ):
         """
         Args:
             assets_dir: Expects file 'protocols.json' and 'whitelist/{protocol}' folder under assets_dir
+            max_read: max number of reads to check in each fastq file
+            cache_dir: folder of the mismatch index cache. Default: beside the whitelist files
+            batch: detect protocols of all sampled reads with numpy in one sweep. False, or numpy not installed,
+                to check reads one by one.
+            threads: number of fastq files to scan concurrently
+            early_stop: stop reading a fastq file once the protocol is statistically certain
+            chunk_size: number of reads detected at a time
+            sampling: "head" reads from the head of each fastq file; "spread" reads from offsets spread across the file.
+            detection_cache_dir: reuse detection results of fastq files with the same fingerprint. Default: no cache
+            force_detect: detect again and overwrite the cached results
+            detection_cache_size: max number of fastq files in the detection cache
 
         Returns:
             protocol, protocol_dict[protocol]
@@ -199,11 +1141,38 @@ class Auto:
         self.fq1_list = fq1_list
         self.max_read = max_read
         self.sample = sample
+        self.cache_dir = cache_dir
+        if batch and np is None:
+            logger.warning("numpy is not installed. Check reads one by one instead of in a vectorized batch.")
+            batch = False
+        self.batch = batch
+        self.threads = threads
+        self.early_stop = early_stop
+        self.chunk_size = chunk_size
+        self.sampling = sampling
+        self.force_detect = force_detect
         self.protocol_dict = get_protocol_dict(assets_dir)
+        self.detection_cache = None
+        if detection_cache_dir:
+            settings = {
+                "max_read": max_read,
+                "sampling": sampling,
+                "early_stop": early_stop,
+                "chunk_size": chunk_size if early_stop else None,
+                "assets_md5": get_assets_md5(self.protocol_dict, assets_dir),
+            }
+            self.detection_cache = DetectionCache(detection_cache_dir, detection_cache_size, settings)
+        # loaded on first use by get_mismatch
         self.mismatch_dict = {}
-        for protocol in self.protocol_dict:
-            if "bc" in self.protocol_dict[protocol]:
-                self.mismatch_dict[protocol] = get_raw_mismatch(self.protocol_dict[protocol]["bc"], 1)
+
+    def get_mismatch(self, protocol):
+        """
+        Returns:
+            raw_list, mismatch_list of protocol
+        """
+        if protocol not in self.mismatch_dict:
+            self.mismatch_dict[protocol] = get_raw_mismatch(self.protocol_dict[protocol]["bc"], 1, self.cache_dir)
+        return self.mismatch_dict[protocol]
 
     def run(self):
         """
@@ -213,12 +1182,37 @@ class Auto:
         protocol = self.get_protocol()
         return protocol, self.protocol_dict[protocol]
 
+    @utils.add_log
     def get_protocol(self):
         """check protocol in the fq1_list"""
-        fq_protocol = {}
-        for fastq1 in self.fq1_list:
-            protocol = self.get_fq_protocol(fastq1)
-            fq_protocol[fastq1] = protocol
+        fq_result = {}
+        if self.detection_cache and not self.force_detect:
+            for fastq1 in self.fq1_list:
+                result = self.detection_cache.get(fastq1)
+                if result:
+                    logger.info(f"{fastq1}: detection cache hit. {result['protocol']}")
+                    fq_result[fastq1] = result
+        todo = [fastq1 for fastq1 in self.fq1_list if fastq1 not in fq_result]
+        if self.threads > 1 and len(todo) > 1:
+            # build mismatch tables once before forking
+            for protocol in BARCODE_PROTOCOLS:
+                self.get_mismatch(protocol)
+            # the runner is handed to each worker once, instead of being pickled with every task
+            with ProcessPoolExecutor(
+                max_workers=min(self.threads, len(todo)), initializer=init_detect_worker, initargs=(self,)
+            ) as executor:
+                fq_result.update(zip(todo, executor.map(detect_fq, todo)))
+        else:
+            fq_result.update((fastq1, self.get_fq_result(fastq1)) for fastq1 in todo)
+        utils.add_rows(sum(fq_result[fastq1]["n_read"] for fastq1 in todo))
+        if self.detection_cache:
+            for fastq1 in todo:
+                self.detection_cache.set(fastq1, fq_result[fastq1])
+            # hits update last_used
+            if self.detection_cache.changed:
+                self.detection_cache.save()
+
+        fq_protocol = {fastq1: self.check_fq_result(fastq1, fq_result[fastq1]) for fastq1 in self.fq1_list}
         if len(set(fq_protocol.values())) != 1:
             sys.exit(f"Error: multiple protocols are not allowed for one sample: {self.sample}! \n" + str(fq_protocol))
         protocol = list(fq_protocol.values())[0]
@@ -226,7 +1220,7 @@ class Auto:
 
     def is_protocol(self, seq, protocol):
         """check if seq matches the barcode of protocol"""
-        raw_list, mismatch_list = self.mismatch_dict[protocol]
+        raw_list, mismatch_list = self.get_mismatch(protocol)
         bc_list = [seq[x] for x in self.protocol_dict[protocol]["pattern_dict"]["C"]]
         valid, _corrected, _res = check_seq_mismatch(bc_list, raw_list, mismatch_list)
         return valid
@@ -254,7 +1248,7 @@ class Auto:
         'GEXSCOPE-MicroBead'
         """
 
-        for protocol in ["GEXSCOPE-V2", "GEXSCOPE-V1"]:
+        for protocol in BARCODE_PROTOCOLS:
             if self.is_protocol(seq, protocol):
                 return protocol
 
@@ -262,23 +1256,102 @@ class Auto:
         if seq[16:20] != "TTTT" and seq[22:26] == "TTTT":
             return "GEXSCOPE-MicroBead"
 
-    def get_fq_protocol(self, fq1):
-        results = defaultdict(int)
+    def batch_is_protocol(self, matrix, protocol):
+        """vectorized is_protocol over the rows of matrix"""
+        _raw_list, mismatch_list = self.get_mismatch(protocol)
+        valid = np.ones(len(matrix), dtype=bool)
+        for sub_slice, mismatch_index in zip(self.protocol_dict[protocol]["pattern_dict"]["C"], mismatch_list):
+            valid &= mismatch_index.get_index_array(matrix[:, sub_slice]) != AMBIGUOUS
+        return valid
+
+    def batch_seq_protocol(self, seqs):
+        """
+        vectorized seq_protocol.
 
-        fq = pyfastx.Fastx(fq1)
-        n = 0
-        for name, seq, qual in fq:
-            n += 1
+        Returns:
+            {protocol: read count}
+
+        >>> runner = Auto([], "fake_sample")
+        >>> seqs = ["TCGACTGTC" + "ATCCACGTGCTTGAGA" + "TTCTAGGAT" + "TCAGCATGCGGCTACG" + "TGCACGAGA" + "C" + "CATATCAATGGG"]
+        >>> seqs.append("NCAGATTC" + "TCGGTGACAGCCATAT" + "GTACGCAA" + "CGTAGTCAGAAGCTGA" + "CTGAGCCA"  + "TCCGAAGCC")
+        >>> seqs.append("ATCGATCGATCG" + "ATCGATCG" + "C" + "TTTTTTTTTT")
+        >>> seqs.append("ATCG")
+        >>> runner.batch_seq_protocol(seqs) == {p: 1 for p in ["GEXSCOPE-V2", "GEXSCOPE-V1", "GEXSCOPE-MicroBead"]}
+        True
+        """
+        width = max([26] + [x.stop for p in BARCODE_PROTOCOLS for x in self.protocol_dict[p]["pattern_dict"]["C"]])
+        matrix = seqs_to_matrix(seqs, width)
+        results = {}
+        remain = np.ones(len(seqs), dtype=bool)
+        for protocol in BARCODE_PROTOCOLS:
+            valid = remain & self.batch_is_protocol(matrix, protocol)
+            results[protocol] = int(valid.sum())
+            remain &= ~valid
+
+        polyt = (matrix[:, 22:26] == ord("T")).all(axis=1) & ~(matrix[:, 16:20] == ord("T")).all(axis=1)
+        results["GEXSCOPE-MicroBead"] = int((remain & polyt).sum())
+        return {k: v for k, v in results.items() if v}
+
+    def count_protocol(self, seqs):
+        """
+        Returns:
+            {protocol: read count}
+        """
+        if self.batch:
+            return self.batch_seq_protocol(seqs)
+        results = defaultdict(int)
+        for seq in seqs:
             protocol = self.seq_protocol(seq)
             if protocol:
                 results[protocol] += 1
-            if n == self.max_read:
+        return results
+
+    def get_fq_result(self, fq1):
+        """
+        Read chunks of reads until max_read, or until is_certain if early_stop.
+
+        Returns:
+            {"protocol", "counts": {protocol: read count}, "n_read", "read_length", "n_read_estimate"}
+        """
+        results = defaultdict(int)
+
+        if self.sampling == "spread":
+            fq = iter_spread_seqs(fq1)
+        else:
+            fq = (seq for _name, seq, _qual in pyfastx.Fastx(fq1))
+        n = total_length = 0
+        while n < self.max_read:
+            chunk_size = min(self.chunk_size, self.max_read - n)
+            seqs = list(itertools.islice(fq, chunk_size))
+            if not seqs:
+                break
+            n += len(seqs)
+            total_length += sum(len(seq) for seq in seqs)
+            for protocol, read_counts in self.count_protocol(seqs).items():
+                results[protocol] += read_counts
+            if self.early_stop and is_certain(results, n):
+                logger.info(f"{fq1}: stop early after {n} reads")
                 break
         sorted_counts = sorted(results.items(), key=lambda x: x[1], reverse=True)
         logger.info(sorted_counts)
 
-        protocol, read_counts = sorted_counts[0]
-        percent = float(read_counts) / n
+        return {
+            "protocol": sorted_counts[0][0] if sorted_counts else None,
+            "counts": dict(sorted_counts),
+            "n_read": n,
+            "read_length": round(total_length / n, 1) if n else 0,
+            "n_read_estimate": estimate_read_count(fq1),
+        }
+
+    @staticmethod
+    def check_fq_result(fq1, result):
+        """
+        Returns:
+            protocol
+        """
+        protocol = result["protocol"]
+        read_counts = result["counts"].get(protocol, 0)
+        percent = float(read_counts) / result["n_read"] if result["n_read"] else 0.0
         if percent < 0.5:
             logger.warning("Valid protocol read counts percent < 0.5")
         if percent < 0.1:
@@ -287,3 +1360,9 @@ class Auto:
         logger.info(f"{fq1}: {protocol}")
 
         return protocol
+
+    @utils.add_log
+    def get_fq_protocol(self, fq1):
+        result = self.get_fq_result(fq1)
+        utils.add_rows(result["n_read"])
+        return self.check_fq_result(fq1, result)
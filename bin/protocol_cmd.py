@@ -30,7 +30,19 @@ class Starsolo:
             whitelist_str = args.whitelist
         else:
             if args.protocol == "auto":
-                runner = parse_protocol.Auto(fq1_list, args.sample)
+                runner = parse_protocol.Auto(
+                    fq1_list,
+                    args.sample,
+                    assets_dir=args.assets_dir,
+                    max_read=args.max_read,
+                    threads=args.thread,
+                    early_stop=args.early_stop,
+                    sampling=args.sampling,
+                    batch=not args.no_batch,
+                    detection_cache_dir=args.cache_dir,
+                    force_detect=args.force_detect,
+                    detection_cache_size=args.cache_size,
+                )
                 protocol, protocol_meta = runner.run()
             else:
                 protocol = args.protocol
@@ -38,6 +50,9 @@ class Starsolo:
             pattern = protocol_meta["pattern"]
             whitelist_str = " ".join(protocol_meta.get("bc", []))
         self.protocol = protocol
+        self.pattern = pattern
+        self.fq1_list = fq1_list
+        self.fq2_list = fq2_list
 
         pattern_args = Starsolo.get_solo_pattern(pattern)
         if not whitelist_str:
@@ -45,6 +60,7 @@ class Starsolo:
         whitelist_str = whitelist_str.strip()
         if whitelist_str.startswith("http"):
             whitelist_str = whitelist_str.split("/")[-1]
+        self.whitelist_files = whitelist_str.split()
         if whitelist_str.endswith(".gz"):
             whitelist_str = f"<(gzip -cdf {whitelist_str})"
         self.cb_umi_args = pattern_args + f" --soloCBwhitelist {whitelist_str} "
@@ -53,8 +69,10 @@ class Starsolo:
         self.cmd_fn = args.sample + ".starsolo_cmd.txt"
 
     @staticmethod
-    def get_solo_pattern(pattern) -> str:
+    def get_solo_pattern(pattern, match_type=None) -> str:
         """
+        Args:
+            match_type: --soloCBmatchWLtype. Default: 1MM for CB_UMI_Simple, EditDist_2 for CB_UMI_Complex
         Returns:
             starsolo_cb_umi_args
         """
@@ -71,13 +89,15 @@ class Starsolo:
             cb_start = start + 1
             cb_len = stop - start
             umi_start = ul + 1
-            cb_str = f"--soloCBstart {cb_start} --soloCBlen {cb_len} --soloCBmatchWLtype 1MM "
+            match_type = match_type or "1MM"
+            cb_str = f"--soloCBstart {cb_start} --soloCBlen {cb_len} --soloCBmatchWLtype {match_type} "
             umi_str = f"--soloUMIstart {umi_start} --soloUMIlen {umi_len} "
         else:
             solo_type = "CB_UMI_Complex"
             cb_pos = " ".join([f"0_{x.start}_0_{x.stop-1}" for x in pattern_dict["C"]])
             umi_pos = f"0_{ul}_0_{ur-1}"
-            cb_str = f"--soloCBposition {cb_pos} --soloCBmatchWLtype EditDist_2 "
+            match_type = match_type or "EditDist_2"
+            cb_str = f"--soloCBposition {cb_pos} --soloCBmatchWLtype {match_type} "
             umi_str = f"--soloUMIposition {umi_pos} --soloUMIlen {umi_len} "
 
         starsolo_cb_umi_args = " ".join([f"--soloType {solo_type} ", cb_str, umi_str])
@@ -109,6 +129,27 @@ if __name__ == "__main__":
     parser.add_argument("--protocol", required=True)
     parser.add_argument("--whitelist")
     parser.add_argument("--pattern")
+    parser.add_argument("--thread", type=int, default=1, help="number of R1 files to scan concurrently")
+    parser.add_argument(
+        "--max_read", type=int, default=100000, help="max number of reads to check in each R1 file for auto detection"
+    )
+    parser.add_argument(
+        "--early_stop", action="store_true", help="stop auto detection once the protocol is statistically certain"
+    )
+    parser.add_argument(
+        "--sampling",
+        choices=["spread", "head"],
+        default="spread",
+        help="spread: sample reads from offsets spread across BGZF or plain fastq files; head: from the head of files",
+    )
+    parser.add_argument(
+        "--no_batch", action="store_true", help="check reads one by one without numpy instead of in a vectorized batch"
+    )
+    parser.add_argument(
+        "--cache_dir", help="reuse auto detection results of fastq files with the same fingerprint. Default: no cache"
+    )
+    parser.add_argument("--force_detect", action="store_true", help="ignore cached detection results")
+    parser.add_argument("--cache_size", type=int, default=1000, help="max number of fastq files in the detection cache")
     # add version
     parser.add_argument("--version", action="version", version="1.0")
 
@@ -117,3 +158,4 @@ if __name__ == "__main__":
     runner = Starsolo(args)
     runner.write_cmd()
     runner.write_stats("scrna")
+    utils.write_perf(args.sample, "scrna", "protocol_cmd")
@@ -1,17 +1,234 @@
 #!/usr/bin/env python
 
 import argparse
+import itertools
 import os
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import utils
 from __init__ import ASSAY
+from mtx import MtxSummary, read_header
+
+logger = utils.get_logger(__name__)
 
 MAX_CELL = 2 * 10**5
 FEATURE_FILE_NAME = "features.tsv.gz"
 BARCODE_FILE_NAME = "barcodes.tsv.gz"
 MATRIX_FILE_NAME = "matrix.mtx.gz"
+READ_STATS_CHUNK_SIZE = 2**20
+# columns of CellReads.stats summed over all whitelist barcodes
+READ_STATS_COLS = [
+    "cbMatch",
+    "cbPerfect",
+    "genomeU",
+    "genomeM",
+    "exonic",
+    "intronic",
+    "exonicAS",
+    "intronicAS",
+    "countedU",
+    "nUMIunique",
+    "nGenesUnique",
+]
+CELL_COLS = ["countedU", "nUMIunique", "nGenesUnique"]
+# matrices summarized in raw/ of each feature. Others, such as UniqueAndMult-EM.mtx, are skipped
+FEATURE_MATRIX_NAMES = ["matrix", "spliced", "unspliced", "ambiguous"]
+
+
+def find_file(directory, name):
+    """STARsolo writes plain files; cell_calling gzips them"""
+    for fn in (name, name + ".gz"):
+        path = os.path.join(directory, fn)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def read_cell_reads_stats(read_stats, cbs, chunksize=READ_STATS_CHUNK_SIZE):
+    """
+    Read only the used columns of CellReads.stats in chunks with int32 dtypes.
+    Whitelist-level columns are summed per chunk and cell rows are selected with a membership mask.
+    Raw barcodes are kept as a fixed-width bytes array instead of Python strings.
+
+    Returns:
+        sums: {column: sum over whitelist barcodes}
+        rbs: raw barcodes
+        umi_count: nUMIunique of each raw barcode
+        cell_df: CELL_COLS of the cell barcodes
+        is_cell: bool array, True for the cell barcodes in rbs
+    """
+    dtypes = {col: np.int32 for col in READ_STATS_COLS}
+    dtypes["CB"] = "object"
+    cb_index = pd.Index(cbs)
+    sums = defaultdict(int)
+    rb_chunks, umi_chunks, cell_chunks, is_cell_chunks = [], [], [], []
+    reader = pd.read_csv(
+        read_stats,
+        sep="\t",
+        header=0,
+        skiprows=[1],  # skip first line cb not pass whitelist
+        usecols=["CB"] + READ_STATS_COLS,
+        dtype=dtypes,
+        chunksize=chunksize,
+    )
+    with reader:
+        for df in reader:
+            for col in READ_STATS_COLS:
+                sums[col] += int(df[col].sum())
+            rb_chunks.append(df["CB"].values.astype("S"))
+            umi_chunks.append(df["nUMIunique"].values)
+            is_cell = df["CB"].isin(cb_index).values
+            cell_chunks.append(df.loc[is_cell, CELL_COLS])
+            is_cell_chunks.append(is_cell)
+    rbs = np.concatenate(rb_chunks)
+    utils.add_rows(len(rbs))
+    return sums, rbs, np.concatenate(umi_chunks), pd.concat(cell_chunks), np.concatenate(is_cell_chunks)
+
+
+def get_read_stats_metrics(sums, cell_df, n_cells):
+    """
+    Returns:
+        mapping and cell metrics from the sums and cell rows of CellReads.stats
+    """
+    valid = sums["cbMatch"]
+    perfect = sums["cbPerfect"]
+    corrected = valid - perfect
+    genome_uniq = sums["genomeU"]
+    genome_multi = sums["genomeM"]
+    mapped = genome_uniq + genome_multi
+    exonic = sums["exonic"]
+    intronic = sums["intronic"]
+    antisense = sums["exonicAS"] + sums["intronicAS"]
+    intergenic = mapped - exonic - intronic - antisense
+    counted_uniq = sums["countedU"]
+    data_dict = {
+        "Corrected Barcodes": corrected / valid,
+        "Reads Mapped To Unique Loci": genome_uniq / valid,
+        "Reads Mapped To Multiple Loci": genome_multi / valid,
+        "Reads Mapped Uniquely To Transcriptome": counted_uniq / valid,
+        "Mapped Reads Assigned To Exonic Regions": exonic / mapped,
+        "Mapped Reads Assigned To Intronic Regions": intronic / mapped,
+        "Mapped Reads Assigned To Intergenic Regions": intergenic / mapped,
+        "Mapped Reads Assigned Antisense To Gene": antisense / mapped,
+    }
+    for k in data_dict:
+        data_dict[k] = utils.get_frac(data_dict[k])
+
+    reads_cell = int(cell_df["countedU"].sum())
+    data_dict.update(
+        {
+            "Estimated Number of Cells": n_cells,
+            "Fraction Reads in Cells": utils.get_frac(float(reads_cell / counted_uniq)),
+            "Mean Used Reads per Cell": int(reads_cell / n_cells),
+            "Median UMI per Cell": int(cell_df["nUMIunique"].median()),
+            "Median Genes per Cell": int(cell_df["nGenesUnique"].median()),
+        }
+    )
+    return data_dict
+
+
+def parse_feature_summary(summary_file, feature):
+    """
+    Returns:
+        Saturation and Reads Mapped Uniquely To Feature from the Summary.csv of a feature
+    """
+    data = utils.csv2dict(summary_file)
+    stats = {}
+    if "Sequencing Saturation" in data:
+        stats["Saturation"] = utils.get_frac(data["Sequencing Saturation"])
+    unique_key = f"Reads Mapped to {feature}: Unique {feature}"
+    if unique_key in data:
+        stats["Reads Mapped Uniquely To Feature"] = utils.get_frac(data[unique_key])
+    return stats
+
+
+def get_cell_mask(barcodes_file, cbs):
+    """
+    Returns:
+        bool array, True for the raw barcodes in cbs
+    """
+    return pd.Index(utils.read_one_col(barcodes_file)).isin(pd.Index(cbs))
+
+
+def is_same_file(file1, file2):
+    """False if either file does not exist"""
+    try:
+        return os.path.samefile(file1, file2)
+    except OSError:
+        return False
+
+
+def find_features(solo_out):
+    """
+    Returns:
+        feature names in Solo.out, such as Gene, GeneFull_Ex50pAS, Velocyto and SJ
+    """
+    return sorted(
+        x
+        for x in os.listdir(solo_out)
+        if os.path.isdir(os.path.join(solo_out, x))
+        and (
+            os.path.isdir(os.path.join(solo_out, x, "raw")) or os.path.exists(os.path.join(solo_out, x, "Summary.csv"))
+        )
+    )
+
+
+def summarize_feature(feature_dir, cbs, cell_mask=None, read_stats_metrics=None):
+    """
+    Stats of one feature directory in Solo.out for the cell barcodes cbs.
+    Each file the feature has is used: Summary.csv, CellReads.stats and the matrices in raw/
+    (matrix.mtx, or spliced/unspliced/ambiguous.mtx for Velocyto).
+
+    Args:
+        cell_mask: cell mask of the raw barcodes shared by all features; computed from raw/barcodes.tsv if None
+            or if the number of raw barcodes differs
+        read_stats_metrics: get_read_stats_metrics of the CellReads.stats of this feature if already parsed
+    Returns:
+        {stat name: value}
+    """
+    feature = os.path.basename(os.path.normpath(feature_dir))
+    stats = {}
+    summary_file = os.path.join(feature_dir, "Summary.csv")
+    if os.path.exists(summary_file):
+        stats.update(parse_feature_summary(summary_file, feature))
+    read_stats = os.path.join(feature_dir, "CellReads.stats")
+    if read_stats_metrics is not None:
+        stats.update(read_stats_metrics)
+    elif os.path.exists(read_stats):
+        sums, _rbs, _umi_count, cell_df, _is_cell = read_cell_reads_stats(read_stats, cbs)
+        stats.update(get_read_stats_metrics(sums, cell_df, len(cbs)))
+
+    raw_dir = os.path.join(feature_dir, "raw")
+    if not os.path.isdir(raw_dir):
+        return stats
+    for name in FEATURE_MATRIX_NAMES:
+        matrix_file = find_file(raw_dir, f"{name}.mtx")
+        if not matrix_file:
+            continue
+        _n_header, (_n_rows, n_cols, _nnz), _dtype = read_header(matrix_file)
+        if cell_mask is None or len(cell_mask) != n_cols:
+            barcodes_file = find_file(raw_dir, "barcodes.tsv")
+            if not barcodes_file:
+                logger.warning(f"{feature}: no barcodes.tsv in {raw_dir}. Skip the matrices of this feature")
+                break
+            cell_mask = get_cell_mask(barcodes_file, cbs)
+        summary = MtxSummary(matrix_file, col_mask=cell_mask)
+        cell_umis = summary.cell_umis[cell_mask]
+        if name == "matrix":
+            stats["Total Features"] = summary.total_genes
+            total_umis = summary.cell_umis.sum()
+            stats["Fraction UMI in Cells"] = utils.get_frac(cell_umis.sum() / total_umis) if total_umis else 0.0
+            detected = summary.gene_umis[summary.gene_umis > 0]
+            stats["Median UMI per Feature"] = int(np.median(detected)) if len(detected) else 0
+            if "Median UMI per Cell" not in stats and cell_mask.any():
+                stats["Median UMI per Cell"] = int(np.median(cell_umis))
+                stats["Median Genes per Cell"] = int(np.median(summary.cell_genes[cell_mask]))
+        else:
+            stats[f"{name.capitalize()} UMI in Cells"] = int(cell_umis.sum())
+    return stats
 
 
 class StarsoloSummary:
@@ -21,85 +238,58 @@ class StarsoloSummary:
         self.matrix_file = os.path.join(args.filtered_matrix, MATRIX_FILE_NAME)
         self.cbs = utils.read_one_col(barcodes_file)
         self.stats = {}
+        # metrics of args.read_stats, reused by summarize_features
+        self.read_stats_metrics = None
 
+    @utils.add_log
     def add_total_genes(self):
-        n = 0
-        genes = set()
-        with utils.openfile(self.matrix_file) as f:
-            for line in f:
-                n += 1
-                if n <= 3:
-                    continue
-                gene = line.split(" ")[0]
-                genes.add(gene)
-        self.stats["Total Genes"] = len(genes)
-
-    def parse_read_stats(self):
-        dtypes = defaultdict(lambda: "int")
-        dtypes["CB"] = "object"
-        df = pd.read_csv(
-            self.args.read_stats, sep="\t", header=0, index_col=0, skiprows=[1], dtype=dtypes
-        )  # skip first line cb not pass whitelist
-        rbs = list(df.index)
-        umi_count = list(df["nUMIunique"])
-        df = df.loc[
-            :,
-            [
-                "cbMatch",
-                "cbPerfect",
-                "genomeU",
-                "genomeM",
-                "exonic",
-                "intronic",
-                "exonicAS",
-                "intronicAS",
-                "countedU",
-                "nUMIunique",
-                "nGenesUnique",
-            ],
+        summary = MtxSummary(self.matrix_file)
+        self.stats["Total Genes"] = summary.total_genes
+        utils.add_rows(summary.nnz)
+
+    @utils.add_log
+    def parse_read_stats(self, chunksize=READ_STATS_CHUNK_SIZE):
+        """
+        Returns:
+            rbs: raw barcodes
+            umi_count: nUMIunique of each raw barcode
+            cbs: cell barcodes found in CellReads.stats
+        """
+        sums, rbs, umi_count, cell_df, is_cell = read_cell_reads_stats(self.args.read_stats, self.cbs, chunksize)
+        self.read_stats_metrics = get_read_stats_metrics(sums, cell_df, len(self.cbs))
+        self.stats.update(self.read_stats_metrics)
+        return rbs, umi_count, rbs[is_cell]
+
+    @utils.add_log
+    def summarize_features(self):
+        """
+        Summarize every feature in Solo.out concurrently.
+        Cell barcodes are parsed once and the cell mask of the raw barcodes is shared by all features.
+        The CellReads.stats already parsed by parse_read_stats is not read again.
+
+        Returns:
+            {feature: stats}
+        """
+        features = find_features(self.args.solo_out)
+        feature_dirs = [os.path.join(self.args.solo_out, x) for x in features]
+        cell_mask = None
+        for feature_dir in feature_dirs:
+            barcodes_file = find_file(os.path.join(feature_dir, "raw"), "barcodes.tsv")
+            if barcodes_file:
+                cell_mask = get_cell_mask(barcodes_file, self.cbs)
+                break
+        metrics = [
+            self.read_stats_metrics if is_same_file(os.path.join(x, "CellReads.stats"), self.args.read_stats) else None
+            for x in feature_dirs
         ]
-        s = df.sum()
-        # json does not recognize NumPy data types. TypeError: Object of type int64 is not JSON serializable
-        valid = int(s["cbMatch"])
-        perfect = int(s["cbPerfect"])
-        corrected = valid - perfect
-        genome_uniq = int(s["genomeU"])
-        genome_multi = int(s["genomeM"])
-        mapped = genome_uniq + genome_multi
-        exonic = int(s["exonic"])
-        intronic = int(s["intronic"])
-        antisense = int(s["exonicAS"] + s["intronicAS"])
-        intergenic = mapped - exonic - intronic - antisense
-        counted_uniq = int(s["countedU"])
-        data_dict = {
-            "Corrected Barcodes": corrected / valid,
-            "Reads Mapped To Unique Loci": genome_uniq / valid,
-            "Reads Mapped To Multiple Loci": genome_multi / valid,
-            "Reads Mapped Uniquely To Transcriptome": counted_uniq / valid,
-            "Mapped Reads Assigned To Exonic Regions": exonic / mapped,
-            "Mapped Reads Assigned To Intronic Regions": intronic / mapped,
-            "Mapped Reads Assigned To Intergenic Regions": intergenic / mapped,
-            "Mapped Reads Assigned Antisense To Gene": antisense / mapped,
-        }
-        for k in data_dict:
-            data_dict[k] = utils.get_frac(data_dict[k])
-        self.stats.update(data_dict)
-
-        n_cells = len(self.cbs)
-        reads_cell = df.loc[self.cbs, "countedU"].sum()
-        fraction_reads_in_cells = utils.get_frac(float(reads_cell / counted_uniq))
-        mean_used_reads_per_cell = int(reads_cell / n_cells)
-        median_umi_per_cell = int(df.loc[self.cbs, "nUMIunique"].median())
-        median_genes_per_cell = int(df.loc[self.cbs, "nGenesUnique"].median())
-        data_dict = {
-            "Estimated Number of Cells": n_cells,
-            "Fraction Reads in Cells": fraction_reads_in_cells,
-            "Mean Used Reads per Cell": mean_used_reads_per_cell,
-            "Median UMI per Cell": median_umi_per_cell,
-            "Median Genes per Cell": median_genes_per_cell,
-        }
-        self.stats.update(data_dict)
-        return rbs, umi_count
+        threads = min(self.args.thread, len(features))
+        args = (feature_dirs, itertools.repeat(self.cbs), itertools.repeat(cell_mask), metrics)
+        if threads > 1:
+            with ProcessPoolExecutor(max_workers=threads) as executor:
+                results = list(executor.map(summarize_feature, *args))
+        else:
+            results = list(map(summarize_feature, *args))
+        return dict(zip(features, results))
 
     def parse_summary(self):
         data = utils.csv2dict(self.args.summary)
@@ -119,12 +309,15 @@ class StarsoloSummary:
         self.stats.update(parsed_data)
 
     def run(self):
-        rbs, umis = self.parse_read_stats()
+        rbs, umis, cbs = self.parse_read_stats()
         self.add_total_genes()
         self.parse_summary()
-        plot_data = utils.get_umi_count(rbs, umis, self.cbs, self.args.sample)
+        plot_data = utils.get_umi_count(rbs, umis, cbs, self.args.sample, self.args.rank_points)
         utils.write_multiqc(plot_data, args.sample, ASSAY, "umi_count")
         utils.write_multiqc(self.stats, args.sample, ASSAY, "starsolo_summary.stats")
+        if self.args.solo_out:
+            utils.write_multiqc(self.summarize_features(), self.args.sample, ASSAY, "features")
+        utils.write_perf(self.args.sample, ASSAY, "starsolo_summary")
 
 
 if __name__ == "__main__":
@@ -133,6 +326,14 @@ if __name__ == "__main__":
     parser.add_argument("--filtered_matrix", help="filtered_matrix")
     parser.add_argument("--summary", help="summary file")
     parser.add_argument("--sample", help="sample name")
+    parser.add_argument("--solo_out", help="optional Solo.out directory. Summarize every feature in it")
+    parser.add_argument("--thread", type=int, default=1, help="number of features to summarize concurrently")
+    parser.add_argument(
+        "--rank_points",
+        type=int,
+        default=500,
+        help="number of log-binned points of each barcode rank segment. 0 to keep every cell barcode",
+    )
     args = parser.parse_args()
 
     StarsoloSummary(args).run()
@@ -1,107 +1,903 @@
 #!/usr/bin/env python
 
 import argparse
-import gzip
+import hashlib
 import json
+import os
 import random
 import statistics
+import struct
+import sys
+import zlib
+from array import array
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
 
 import pysam
+import utils
 
+try:
+    import numpy as np
+except ImportError:
+    # the shuffle mode falls back to python_curves without numpy
+    np = None
 
-def openfile(file_name, mode="rt", **kwargs):
-    """open gzip or plain file"""
-    if file_name.endswith(".gz"):
-        file_obj = gzip.open(file_name, mode=mode, **kwargs)
-    else:
-        file_obj = open(file_name, mode=mode, **kwargs)
-    return file_obj
+logger = utils.get_logger(__name__)
+
+# 2-bit base codes. "_" joins the segments of CB_UMI_Complex barcodes at fixed positions and is dropped
+PACK_TABLE = str.maketrans({"A": "0", "C": "1", "G": "2", "T": "3", "_": None})
+# a leading 1 keeps the length, so 2 * 31 + 1 bits fit in int64
+MAX_PACK_LEN = 31
+
+
+class SeqEncoder:
+    """
+    Encode barcode or UMI as an int.
+    Sequences of ACGT no longer than MAX_PACK_LEN are 2-bit packed (>= 0);
+    others (e.g. with N) get negative dictionary ids.
+
+    >>> encoder = SeqEncoder()
+    >>> encoder.encode("ACGT"), encoder.encode("AC_GT"), encoder.encode("CA")
+    (283, 283, 20)
+    >>> encoder.encode("ACNT"), encoder.encode("ACNT"), encoder.encode("A" * 32)
+    (-1, -1, -2)
+    """
+
+    def __init__(self):
+        self.fallback = {}
+
+    def encode(self, seq):
+        digits = seq.translate(PACK_TABLE)
+        if len(digits) <= MAX_PACK_LEN:
+            try:
+                return int("1" + digits, 4)
+            except ValueError:
+                pass
+        if seq not in self.fallback:
+            self.fallback[seq] = -len(self.fallback) - 1
+        return self.fallback[seq]
+
+
+def hash_name(name):
+    """64-bit read name hash, the same in every process"""
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
+class HashSet:
+    """
+    Open-addressing set of 64-bit hashes in a numpy array: 16 bytes per item at most half load,
+    instead of about 70 bytes per item of a Python set of ints.
+
+    >>> hash_set = HashSet(capacity=4)
+    >>> [hash_set.add(x) for x in (5, 9, 5, 0, 2**64 - 1, 13, 0)]
+    [True, True, False, True, True, True, False]
+    >>> len(hash_set), len(hash_set.table)
+    (5, 16)
+    """
+
+    def __init__(self, capacity=2**16):
+        self.table = np.zeros(capacity, dtype=np.uint64)
+        self.mask = capacity - 1
+        self.n = 0
+
+    def add(self, h):
+        """
+        Returns:
+            True if h is new
+        """
+        # 0 marks empty slots
+        h = h or 1
+        table, mask = self.table, self.mask
+        i = h & mask
+        while True:
+            x = int(table[i])
+            if x == 0:
+                table[i] = h
+                self.n += 1
+                if self.n * 2 > len(table):
+                    self.grow()
+                return True
+            if x == h:
+                return False
+            i = (i + 1) & mask
+
+    def grow(self):
+        items = self.table[self.table != 0]
+        self.__init__(len(self.table) * 2)
+        for h in items.tolist():
+            self.add(h)
+
+    def __len__(self):
+        return self.n
 
 
-def read_one_col(fn):
-    """read one column file into list"""
-    with openfile(fn) as f:
-        return [x.strip() for x in f]
+def min_by_key(keys, values, *payloads):
+    """
+    Returns:
+        sorted unique keys, the minimum value of each key and the payloads of that row
 
+    >>> min_by_key(np.array([7, 3, 7]), np.array([2, 5, 1]), np.array([0, 1, 2]))
+    (array([3, 7]), array([5, 1]), array([1, 2]))
+    """
+    order = np.lexsort((values, keys))
+    keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    index = order[first]
+    return (keys[first], values[index]) + tuple(payload[index] for payload in payloads)
 
-def get_records(bam_file):
-    a = []
-    cb_int = {}
-    ub_int = {}
+
+class MinTable:
+    """
+    Minimum value of each uint64 key, with an int32 payload of that row.
+    Rows are buffered in compact arrays and reduced into sorted runs of unique keys, and runs are merged when a run
+    is at least half the size of the previous one, so there are O(log n) runs and each key costs 14 bytes
+    instead of a Python dict entry with a tuple key.
+
+    >>> table = MinTable(buffer_size=2)
+    >>> for key, value, payload in ((5, 3, 0), (9, 1, 1), (5, 2, 0), (5, 4, 0), (1, 0, -1)):
+    ...     table.add(key, value, payload)
+    >>> keys, values, payloads = table.result()
+    >>> keys.tolist(), values.tolist(), payloads.tolist()
+    ([1, 5, 9], [0, 2, 1], [-1, 0, 1])
+    """
+
+    def __init__(self, buffer_size=2**20):
+        self.buffer_size = buffer_size
+        self.runs = []
+        self.new_buffer()
+
+    def new_buffer(self):
+        self.keys, self.values, self.payloads = array("Q"), array("h"), array("i")
+
+    def add(self, key, value, payload=-1):
+        self.keys.append(key)
+        self.values.append(value)
+        self.payloads.append(payload)
+        if len(self.keys) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if not self.keys:
+            return
+        run = min_by_key(*(np.frombuffer(x, dtype=x.typecode) for x in (self.keys, self.values, self.payloads)))
+        self.new_buffer()
+        self.runs.append(run)
+        while len(self.runs) > 1 and len(self.runs[-1][0]) * 2 >= len(self.runs[-2][0]):
+            self.merge(2)
+
+    def merge(self, n):
+        runs, self.runs = self.runs[-n:], self.runs[:-n]
+        self.runs.append(min_by_key(*(np.concatenate(columns) for columns in zip(*runs))))
+
+    def result(self):
+        """
+        Returns:
+            keys, values, payloads: sorted by key
+        """
+        self.flush()
+        if not self.runs:
+            return np.array([], dtype=np.uint64), np.array([], dtype=np.int16), np.array([], dtype=np.int32)
+        self.merge(len(self.runs))
+        return self.runs[0]
+
+
+def get_regions(bam, n_region):
+    """
+    Split contigs into about n_region regions with similar numbers of mapped reads, in bam order.
+
+    Returns:
+        list of (contig, start, end)
+    """
+    stats = {x.contig: x.mapped for x in bam.get_index_statistics()}
+    total = sum(stats.values())
+    regions = []
+    for contig, length in zip(bam.references, bam.lengths):
+        mapped = stats.get(contig, 0)
+        if not mapped:
+            continue
+        n = max(1, round(n_region * mapped / total))
+        bounds = [length * i // n for i in range(n + 1)]
+        regions.extend((contig, start, end) for start, end in zip(bounds, bounds[1:]))
+    return regions
+
+
+def scan_region(bam_file, region=None, multimapper="first"):
+    """
+    Args:
+        region: (contig, start, end). Only reads starting in [start, end) are kept. None to scan the whole file.
+        multimapper: "first" returns name hashes of multimapped reads to keep their first valid alignment;
+            "primary" keeps only the alignment with HI == 1.
+    Returns:
+        cb, ub, gx: int arrays, codes and gene ids local to this region
+        multi_index, multi_hash: row and read name hash of multimapped reads
+        cb_fallback, ub_fallback: SeqEncoder.fallback
+        gx_names: gene of each local gene id
+        n_dedup: number of alignments skipped by "primary"
+    """
+    # growable columns instead of a list of tuples: 20 bytes per read
+    cb_col, ub_col, gx_col = array("q"), array("q"), array("i")
+    multi_index, multi_hash = array("q"), array("Q")
+    cb_encoder, ub_encoder = SeqEncoder(), SeqEncoder()
+    cb_encode, ub_encode = cb_encoder.encode, ub_encoder.encode
     gx_int = {}
-    n_cb = n_ub = n_gx = n_read = 0
-    dup_align_read_names = set()
+    primary = multimapper == "primary"
+    n_dedup = 0
     with pysam.AlignmentFile(bam_file) as bam:
-        for record in bam:
+        if region:
+            contig, start, end = region
+            records = bam.fetch(contig, start, end)
+        else:
+            start = end = None
+            records = bam
+        for record in records:
+            if region and not start <= record.reference_start < end:
+                continue
             cb = record.get_tag("CB")
             ub = record.get_tag("UB")
             gx = record.get_tag("GX")
-            if all(x != "-" for x in (cb, ub, gx)):
+            if "-" not in (cb, ub, gx):
                 if record.get_tag("NH") > 1:
-                    if record.query_name in dup_align_read_names:
-                        continue
+                    if primary:
+                        if record.get_tag("HI") != 1:
+                            n_dedup += 1
+                            continue
                     else:
-                        dup_align_read_names.add(record.query_name)
-                # use int instead of str to avoid memory hog
-                if cb not in cb_int:
-                    n_cb += 1
-                    cb_int[cb] = n_cb
-                if ub not in ub_int:
-                    n_ub += 1
-                    ub_int[ub] = n_ub
+                        multi_index.append(len(cb_col))
+                        multi_hash.append(hash_name(record.query_name))
                 if gx not in gx_int:
-                    n_gx += 1
-                    gx_int[gx] = n_gx
-                a.append((cb_int[cb], ub_int[ub], gx_int[gx]))
-                n_read += 1
-    return a, cb_int
-
-
-def sub_saturation(a):
-    """get saturation and median gene"""
-    n = len(a)
-    fraction_saturation = {0.0: 0.0}
-    for fraction in range(1, 11):
-        fraction /= 10.0
-        nread = int(n * fraction)
-        uniq = len(set(a[:nread]))
-        saturation = 1 - float(uniq) / nread
-        saturation = round(saturation * 100, 2)
-        fraction_saturation[fraction] = saturation
+                    gx_int[gx] = len(gx_int)
+                cb_col.append(cb_encode(cb))
+                ub_col.append(ub_encode(ub))
+                gx_col.append(gx_int[gx])
+    arrays = [np.frombuffer(x, dtype=x.typecode) for x in (cb_col, ub_col, gx_col, multi_index, multi_hash)]
+    return arrays + [cb_encoder.fallback, ub_encoder.fallback, list(gx_int), n_dedup]
+
+
+def remap_fallback(codes, fallback, encoder):
+    """
+    replace local negative ids in codes with ids of encoder, in place
+
+    >>> encoder = SeqEncoder()
+    >>> _ = encoder.encode("NNA")
+    >>> codes = np.array([5, -1, -2])
+    >>> remap_fallback(codes, {"NNC": -1, "NNA": -2}, encoder)
+    >>> codes
+    array([ 5, -2, -1])
+    """
+    if not fallback:
+        return
+    lookup = np.zeros(len(fallback), dtype=np.int64)
+    for seq, local_id in fallback.items():
+        lookup[-local_id - 1] = encoder.encode(seq)
+    neg = codes < 0
+    codes[neg] = lookup[-codes[neg] - 1]
+
+
+@utils.add_log
+def get_records(bam_file, threads=1, multimapper="first"):
+    """
+    Scan bam regions in a process pool and merge them in bam order. With one thread, the bam is scanned in this process.
+    Multimapped reads keep their first valid alignment in bam order across regions,
+    or their HI == 1 alignment if multimapper is "primary".
+
+    Returns:
+        cb, ub: int64 arrays of SeqEncoder codes, one element per read
+        gx: int32 array of gene ids
+        cb_encoder: to encode cell barcodes the same way as cb
+        n_dedup: number of deduplicated multimapped alignments
+    """
+    if threads > 1:
+        if not os.path.exists(bam_file + ".bai"):
+            pysam.index("-@", str(threads), bam_file)
+        with pysam.AlignmentFile(bam_file) as bam:
+            regions = get_regions(bam, threads * 4)
+        with Pool(threads) as pool:
+            shards = pool.starmap(scan_region, [(bam_file, region, multimapper) for region in regions])
+    else:
+        shards = [scan_region(bam_file, None, multimapper)]
+
+    cb_encoder, ub_encoder = SeqEncoder(), SeqEncoder()
+    gx_int = {}
+    multi_index, multi_hash = [], []
+    offset = n_dedup = 0
+    for shard in shards:
+        cb, ub, gx, shard_multi_index, shard_multi_hash, cb_fallback, ub_fallback, gx_names, shard_dedup = shard
+        n_dedup += shard_dedup
+        remap_fallback(cb, cb_fallback, cb_encoder)
+        remap_fallback(ub, ub_fallback, ub_encoder)
+        gx_lookup = np.array([gx_int.setdefault(x, len(gx_int)) for x in gx_names], dtype=np.int32)
+        if len(gx):
+            gx[:] = gx_lookup[gx]
+        multi_index.append(shard_multi_index + offset)
+        multi_hash.append(shard_multi_hash)
+        offset += len(cb)
+    if len(shards) == 1:
+        cb, ub, gx = shards[0][:3]
+    else:
+        cb, ub, gx = (np.concatenate([shard[i] for shard in shards]) for i in range(3))
+    del shards
+    utils.add_rows(len(cb))
+
+    multi_index = np.concatenate(multi_index)
+    _uniq, first = np.unique(np.concatenate(multi_hash), return_index=True)
+    n_drop = len(multi_index) - len(first)
+    n_dedup += n_drop
+    if n_drop:
+        keep = np.ones(len(cb), dtype=bool)
+        keep[multi_index] = False
+        keep[multi_index[first]] = True
+        cb, ub, gx = cb[keep], ub[keep], gx[keep]
+    return cb, ub, gx, cb_encoder, n_dedup
+
+
+def first_occurrence(*columns):
+    """
+    Returns:
+        sorted read index of the first occurrence of each unique row
+
+    >>> first_occurrence(np.array([5, 5, 7, 5]), np.array([1, 1, 1, 2]))
+    array([0, 2, 3])
+    """
+    if len(columns[0]) == 0:
+        return np.array([], dtype=np.int64)
+    # stable sort: the first row of each group of equal rows has the smallest read index
+    order = np.lexsort(columns[::-1])
+    new = np.zeros(len(order), dtype=bool)
+    new[0] = True
+    for col in columns:
+        sorted_col = col[order]
+        new[1:] |= sorted_col[1:] != sorted_col[:-1]
+        del sorted_col
+    first_index = order[new]
+    first_index.sort()
+    return first_index
+
+
+@utils.add_log
+def shuffle_columns(columns, seed=0):
+    """
+    Shuffle the rows of equal-length columns with one permutation, in place of the list items.
+    Columns are permuted one at a time, so at most one extra column is in memory if the list holds the only reference.
+
+    >>> cb, gx = shuffle_columns([np.arange(5), np.arange(5) * 10], seed=1)
+    >>> bool((gx == cb * 10).all()), sorted(cb.tolist())
+    (True, [0, 1, 2, 3, 4])
+    """
+    order = np.random.default_rng(seed).permutation(len(columns[0]))
+    utils.add_rows(len(order))
+    for i in range(len(columns)):
+        columns[i] = columns[i][order]
+    return columns
+
+
+def get_fractions(steps, max_fraction=1.0):
+    """
+    >>> get_fractions(4)
+    [0.0, 0.25, 0.5, 0.75, 1.0]
+    >>> get_fractions(2, 2.0)
+    [0.0, 0.5, 1.0, 1.5, 2.0]
+    """
+    return [round(i / steps, 4) for i in range(int(round(steps * max_fraction)) + 1)]
+
+
+def get_saturation(nreads, uniqs, fractions):
+    """
+    >>> get_saturation([0, 2, 4], [0, 1, 2], [0.0, 0.5, 1.0])
+    {0.0: 0.0, 0.5: 50.0, 1.0: 50.0}
+    """
+    fraction_saturation = {}
+    for fraction, nread, uniq in zip(fractions, nreads, uniqs):
+        saturation = 1 - float(uniq) / nread if nread else 0.0
+        fraction_saturation[fraction] = round(saturation * 100, 2)
     return fraction_saturation
 
 
-def sub_gene(a, barcodes):
-    """get median gene for each fraction"""
-    nread_fraction = {}
-    n = len(a)
-    for fraction in range(11):
-        fraction /= 10.0
-        nread = int(n * fraction)
-        nread_fraction[nread] = fraction
-
-    fraction_mg = {0.0: 0}
-    cb_gx = defaultdict(set)
-    for i, (cb, _, gx) in enumerate(a, start=1):
-        if cb in barcodes:
-            cb_gx[cb].add(gx)
-        if i in nread_fraction:
-            fraction = nread_fraction[i]
-            fraction_mg[fraction] = int(statistics.median([len(x) for x in cb_gx.values()]))
+@utils.add_log
+def sub_saturation(first_index, n, fractions):
+    """
+    get saturation for each fraction in one pass.
+    The number of unique molecules in the first nread reads is the number of molecules first seen before nread.
+
+    >>> sub_saturation(np.array([0, 2]), 4, [0.0, 0.5, 1.0])
+    {0.0: 0.0, 0.5: 50.0, 1.0: 50.0}
+    """
+    utils.add_rows(n)
+    nreads = [int(n * fraction) for fraction in fractions]
+    uniqs = np.searchsorted(first_index, nreads)
+    return get_saturation(nreads, uniqs, fractions)
+
+
+def get_cell_index(cb, barcodes):
+    """
+    Returns:
+        index of each cb in barcodes; -1 if cb is not a cell barcode
+
+    >>> get_cell_index(np.array([7, 3, 5, 3]), np.array([3, 7]))
+    array([ 1,  0, -1,  0])
+    """
+    if len(barcodes) == 0:
+        return np.full(len(cb), -1, dtype=np.int64)
+    order = np.argsort(barcodes)
+    sorted_barcodes = barcodes[order]
+    pos = np.searchsorted(sorted_barcodes, cb).clip(max=len(barcodes) - 1)
+    return np.where(sorted_barcodes[pos] == cb, order[pos], -1)
+
+
+def get_curves(first_index, cell, nreads, n_cell):
+    """
+    Args:
+        first_index: read index of the first occurrence of each (cell, feature)
+        cell: cell index of each (cell, feature)
+        nreads: number of reads at each checkpoint
+    Returns:
+        int32 array of shape (n_cell, len(nreads)): number of features of each cell at each checkpoint
+
+    >>> get_curves(np.array([0, 1, 3]), np.array([0, 1, 0]), np.array([0, 2, 4]), 2)
+    array([[0, 1, 2],
+           [0, 1, 1]], dtype=int32)
+    """
+    n_step = len(nreads)
+    # index of the first checkpoint that includes the read
+    step = np.searchsorted(nreads, first_index, side="right")
+    counts = np.bincount(cell * (n_step + 1) + step, minlength=n_cell * (n_step + 1))
+    counts = counts.reshape(n_cell, n_step + 1)[:, :n_step]
+    return counts.cumsum(axis=1).astype(np.int32)
+
+
+@utils.add_log
+def sub_cell(cb, ub, gx, barcodes, fractions):
+    """
+    Per-cell gene and UMI curves from the first occurrence of each (cell, gene) and (cell, umi, gene) in the reads.
+
+    Returns:
+        genes, umis: int32 arrays of shape (n_cell, len(fractions))
+    """
+    utils.add_rows(len(cb))
+    cell = get_cell_index(cb, barcodes)
+    mask = cell >= 0
+    read_index = np.flatnonzero(mask)
+    cell, ub, gx = cell[mask], ub[mask], gx[mask]
+    nreads = np.array([int(len(cb) * fraction) for fraction in fractions], dtype=np.int64)
+    curves = []
+    for columns in ((cell, gx), (cell, ub, gx)):
+        first_index = first_occurrence(*columns)
+        curves.append(get_curves(read_index[first_index], cell[first_index], nreads, len(barcodes)))
+    genes, umis = curves
+    return genes, umis
+
+
+def sub_gene(genes, fractions):
+    """
+    get median gene for each fraction, over the cells with at least one read
+
+    >>> sub_gene(np.array([[0, 1, 2], [0, 0, 4], [0, 3, 5]]), [0.0, 0.5, 1.0])
+    {0.0: 0, 0.5: 2, 1.0: 4}
+    """
+    fraction_mg = {}
+    for fraction, n_genes in zip(fractions, genes.T):
+        n_genes = n_genes[n_genes > 0]
+        fraction_mg[fraction] = int(np.median(n_genes)) if len(n_genes) else 0
     return fraction_mg
 
 
+class HyperLogLog:
+    """
+    One HyperLogLog sketch per bucket. Sketches of buckets below each checkpoint are merged to estimate
+    the number of unique items at that checkpoint.
+
+    >>> hll = HyperLogLog(2, p=10)
+    >>> rng = np.random.default_rng(0)
+    >>> hll.add(np.zeros(5000, dtype=np.int64), rng.integers(0, 2**64, 5000, dtype=np.uint64))
+    >>> estimates = hll.cumulative_estimates()
+    >>> estimates[0], abs(estimates[1] - 5000) < 500, estimates[1] == estimates[2]
+    (0, True, True)
+    """
+
+    def __init__(self, n_bucket, p=14):
+        self.p = p
+        self.m = 1 << p
+        self.registers = np.zeros((n_bucket, self.m), dtype=np.uint8)
+
+    def add(self, buckets, hashes):
+        """
+        Args:
+            buckets: int array
+            hashes: uint64 array of item hashes
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        index = (hashes >> np.uint64(64 - self.p)).astype(np.int64)
+        # rank: position of the leftmost 1 bit in the next 32 bits, exact in float64
+        rest = ((hashes << np.uint64(self.p)) >> np.uint64(32)).astype(np.float64)
+        rank = np.full(len(hashes), 33, dtype=np.uint8)
+        nonzero = rest > 0
+        rank[nonzero] = 32 - np.floor(np.log2(rest[nonzero])).astype(np.uint8)
+        np.maximum.at(self.registers, (np.asarray(buckets, dtype=np.int64), index), rank)
+
+    def estimate(self, registers):
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        raw = alpha * self.m**2 / np.sum(np.power(2.0, -registers.astype(np.float64)))
+        n_zero = int(np.sum(registers == 0))
+        if raw <= 2.5 * self.m and n_zero:
+            # linear counting for small cardinalities
+            return int(round(self.m * np.log(self.m / n_zero)))
+        return int(round(raw))
+
+    def cumulative_estimates(self):
+        """
+        Returns:
+            estimate of unique items in buckets [0, i) for i in 0..n_bucket
+        """
+        merged = np.zeros(self.m, dtype=np.uint8)
+        estimates = [0]
+        for registers in self.registers:
+            np.maximum(merged, registers, out=merged)
+            estimates.append(self.estimate(merged))
+        return estimates
+
+
+def get_bucket(name, seed, steps):
+    """
+    Deterministic fraction bucket of a read. A read is in the subsample of fraction i / steps if its bucket < i.
+
+    >>> get_bucket("read1", 0, 100) == get_bucket("read1", 0, 100)
+    True
+    """
+    return (zlib.crc32(name.encode(), seed) * steps) >> 32
+
+
+def hash_molecule(cb, ub, gx):
+    return int.from_bytes(hashlib.blake2b(struct.pack("<qqi", cb, ub, gx), digest_size=8).digest(), "little")
+
+
+def clip_estimates(uniqs, nreads):
+    """
+    Make estimates of unique molecules at each checkpoint non-decreasing and no more than the number of reads.
+
+    >>> clip_estimates([0, 12, 9, 30], [0, 10, 20, 40]).tolist()
+    [0, 10, 12, 30]
+
+    With the default p=14 (1% standard error), saturation of 100000 reads of 20000 molecules is within 2.5 points:
+
+    >>> rng = np.random.default_rng(1)
+    >>> molecule = rng.integers(0, 20000, 100000)
+    >>> hashes = rng.integers(0, 2**64, 20000, dtype=np.uint64)[molecule]
+    >>> buckets = rng.integers(0, 10, 100000)
+    >>> hll = HyperLogLog(10)
+    >>> hll.add(buckets, hashes)
+    >>> nreads = np.concatenate([[0], np.cumsum(np.bincount(buckets))])
+    >>> uniqs = clip_estimates(hll.cumulative_estimates(), nreads)
+    >>> exact = [len(np.unique(molecule[buckets < i])) for i in range(11)]
+    >>> fractions = get_fractions(10)
+    >>> approx, truth = get_saturation(nreads, uniqs, fractions), get_saturation(nreads, exact, fractions)
+    >>> bool(max(abs(approx[f] - truth[f]) for f in fractions) < 2.5)
+    True
+    """
+    return np.minimum(np.maximum.accumulate(np.asarray(uniqs)), nreads)
+
+
+@utils.add_log
+def stream_records(bam_file, barcodes, cb_encoder, steps, seed=0, sketch=False, multimapper="first"):
+    """
+    Read the bam once. Each read is assigned to a fraction bucket by the hash of its name, and only the first bucket
+    of each molecule and (cell, gene) is kept in MinTables, so memory is O(unique molecules),
+    or O(cell genes + sketch size) if sketch. Molecules are identified by 64-bit hashes.
+    With multimapper "first", a HashSet of the names of multimapped reads adds O(multimapped reads);
+    "primary" needs no name table.
+
+    Args:
+        barcodes: cell barcode codes
+        cb_encoder: SeqEncoder that encoded barcodes
+    Returns:
+        read_counts: number of reads in each bucket
+        uniqs: number of unique molecules at each checkpoint, estimated with HyperLogLog if sketch
+        cell_gene: (cell index, first bucket) arrays of each (cell, gene)
+        cell_molecules: (cell index, first bucket) arrays of each molecule in cells; None if sketch
+        n_dedup: number of deduplicated multimapped alignments
+    """
+    cell_index = {x: i for i, x in enumerate(barcodes.tolist())}
+    read_counts = [0] * steps
+    molecules = MinTable()
+    cell_gene = MinTable()
+    hll = HyperLogLog(steps) if sketch else None
+    hll_buckets, hll_hashes = array("q"), array("Q")
+    cb_encode, ub_encode = cb_encoder.encode, SeqEncoder().encode
+    gx_int = {}
+    primary = multimapper == "primary"
+    multi_names = HashSet()
+    n_dedup = 0
+    with pysam.AlignmentFile(bam_file) as bam:
+        for record in bam:
+            cb = record.get_tag("CB")
+            ub = record.get_tag("UB")
+            gx = record.get_tag("GX")
+            if "-" in (cb, ub, gx):
+                continue
+            name = record.query_name
+            if record.get_tag("NH") > 1:
+                if record.get_tag("HI") != 1 if primary else not multi_names.add(hash_name(name)):
+                    n_dedup += 1
+                    continue
+            bucket = get_bucket(name, seed, steps)
+            read_counts[bucket] += 1
+            if gx not in gx_int:
+                gx_int[gx] = len(gx_int)
+            cb_code, ub_code, gx_id = cb_encode(cb), ub_encode(ub), gx_int[gx]
+            cell = cell_index.get(cb_code, -1)
+            molecule_hash = hash_molecule(cb_code, ub_code, gx_id)
+            if sketch:
+                hll_buckets.append(bucket)
+                hll_hashes.append(molecule_hash)
+                if len(hll_buckets) >= 10**6:
+                    hll.add(hll_buckets, hll_hashes)
+                    hll_buckets, hll_hashes = array("q"), array("Q")
+            else:
+                molecules.add(molecule_hash, bucket, cell)
+            if cell >= 0:
+                cell_gene.add((cell << 32) | gx_id, bucket, cell)
+
+    nreads = np.concatenate([[0], np.cumsum(read_counts)])
+    cell_molecules = None
+    if sketch:
+        hll.add(hll_buckets, hll_hashes)
+        uniqs = clip_estimates(hll.cumulative_estimates(), nreads)
+    else:
+        _keys, first_bucket, cell = molecules.result()
+        uniqs = np.concatenate([[0], np.cumsum(np.bincount(first_bucket, minlength=steps))])
+        cell_molecules = (cell[cell >= 0], first_bucket[cell >= 0])
+    del molecules
+    _keys, first_bucket, cell = cell_gene.result()
+    utils.add_rows(sum(read_counts) + n_dedup)
+    return read_counts, uniqs, (cell, first_bucket), cell_molecules, n_dedup
+
+
+def stream_curves(args, barcodes, cb_encoder):
+    """
+    Returns:
+        fraction_saturation, genes, umis. umis is None if args.sketch
+    """
+    steps = args.steps
+    fractions = get_fractions(steps)
+    read_counts, uniqs, cell_gene, cell_molecules, n_dedup = stream_records(
+        args.bam, barcodes, cb_encoder, steps, args.seed, args.sketch, args.multimapper
+    )
+    logger.info(f"{n_dedup} multimapped alignments deduplicated")
+    nreads = np.concatenate([[0], np.cumsum(read_counts)])
+    fraction_saturation = get_saturation(nreads, uniqs, fractions)
+    # a first bucket b is included from checkpoint b + 1
+    checkpoints = np.arange(steps + 1)
+    cell, first_bucket = cell_gene
+    genes = get_curves(first_bucket.astype(np.int64), cell.astype(np.int64), checkpoints, len(barcodes))
+    umis = None
+    if cell_molecules is not None:
+        cell, first_bucket = cell_molecules
+        umis = get_curves(first_bucket.astype(np.int64), cell.astype(np.int64), checkpoints, len(barcodes))
+    return fraction_saturation, genes, umis
+
+
+def group_rows(*columns):
+    """
+    Returns:
+        order: lexsort order of the rows
+        starts: positions in order where each group of equal rows starts
+    """
+    order = np.lexsort(columns[::-1])
+    new = np.zeros(len(order), dtype=bool)
+    new[:1] = True
+    for col in columns:
+        sorted_col = col[order]
+        new[1:] |= sorted_col[1:] != sorted_col[:-1]
+        del sorted_col
+    return order, np.flatnonzero(new)
+
+
+def get_molecules(cb, ub, gx):
+    """
+    Returns:
+        cb, ub, gx and n_reads of each molecule
+
+    >>> get_molecules(np.array([1, 1, 2, 1]), np.array([3, 3, 3, 4]), np.array([0, 0, 0, 0]))
+    (array([1, 1, 2]), array([3, 4, 3]), array([0, 0, 0]), array([2, 1, 1], dtype=int32))
+    """
+    order, starts = group_rows(cb, ub, gx)
+    n_reads = np.diff(np.append(starts, len(order))).astype(np.int32)
+    index = order[starts]
+    return cb[index], ub[index], gx[index], n_reads
+
+
+def save_molecules(fn, cb, ub, gx, n_reads, cb_encoder):
+    # fallback ids are -1, -2, ... in insertion order
+    cb_fallback = np.array(list(cb_encoder.fallback), dtype=str)
+    np.savez_compressed(fn, cb=cb, ub=ub, gx=gx, n_reads=n_reads, cb_fallback=cb_fallback)
+
+
+def load_molecules(fn):
+    """
+    Returns:
+        cb, ub, gx, n_reads, cb_encoder
+    """
+    data = np.load(fn)
+    cb_encoder = SeqEncoder()
+    cb_encoder.fallback = {seq: -i - 1 for i, seq in enumerate(data["cb_fallback"].tolist())}
+    return data["cb"], data["ub"], data["gx"], data["n_reads"], cb_encoder
+
+
+def thin_curves(group, n_reads, n_group, fractions):
+    """
+    Expected number of items with at least one read in each group, when each read is kept with probability fraction:
+    an item with n reads is kept with probability 1 - (1 - fraction) ** n.
+    Items are first collapsed into a histogram of (group, n_reads), so the cost does not grow with the number of items.
+
+    Returns:
+        float array of shape (n_group, len(fractions))
+
+    >>> thin_curves(np.array([0, 0, 1]), np.array([1, 2, 1]), 2, [0.0, 0.5, 1.0])
+    array([[0.  , 1.25, 2.  ],
+           [0.  , 0.5 , 1.  ]])
+    """
+    order, starts = group_rows(group, n_reads)
+    count = np.diff(np.append(starts, len(order)))
+    group, n_reads = group[order[starts]], n_reads[order[starts]].astype(np.float64)
+    curves = np.zeros((n_group, len(fractions)))
+    for i, fraction in enumerate(fractions):
+        weights = count * (1 - (1 - fraction) ** n_reads)
+        curves[:, i] = np.bincount(group, weights=weights, minlength=n_group)
+    return curves
+
+
+def extrapolate(curves, fractions, min_fit_fraction=0.5):
+    """
+    Fit the Michaelis-Menten curve U(f) = f / (a + b * f), i.e. 1 / U = a / f + b, to each row on fractions in [min_fit_fraction, 1]
+    and replace the values at fractions above 1 with the fitted curve.
+
+    >>> fractions = [0.5, 1.0, 2.0]
+    >>> extrapolate(np.array([[2 / 3, 1.0, 0.0]]), fractions)
+    array([[0.66666667, 1.        , 1.33333333]])
+    """
+    fractions = np.asarray(fractions)
+    fit = (fractions >= min_fit_fraction) & (fractions <= 1)
+    new = fractions > 1
+    if not new.any() or fit.sum() < 2:
+        return curves
+    x = 1 / fractions[fit]
+    y = np.zeros_like(curves[:, fit])
+    np.divide(1, curves[:, fit], out=y, where=curves[:, fit] > 0)
+    x_mean, y_mean = x.mean(), y.mean(axis=1, keepdims=True)
+    a = ((x - x_mean) * (y - y_mean)).sum(axis=1) / ((x - x_mean) ** 2).sum()
+    b = y_mean[:, 0] - a * x_mean
+    denom = a[:, None] / fractions[new] + b[:, None]
+    values = np.zeros_like(denom)
+    np.divide(1, denom, out=values, where=denom > 0)
+    # rows without reads stay 0
+    values[(curves[:, fit] <= 0).any(axis=1)] = 0
+    curves[:, new] = values
+    return curves
+
+
+@utils.add_log
+def analytic_curves(cb, ub, gx, n_reads, barcodes, fractions):
+    """
+    Expected saturation and per-cell gene and UMI curves from the molecule table by binomial thinning.
+    Fractions above 1 are extrapolated.
+
+    Returns:
+        fraction_saturation, genes, umis
+    """
+    utils.add_rows(len(n_reads))
+    n_total = int(n_reads.sum())
+    uniqs = extrapolate(thin_curves(np.zeros(len(n_reads), dtype=np.int64), n_reads, 1, fractions), fractions)[0]
+    nreads = [fraction * n_total for fraction in fractions]
+    fraction_saturation = get_saturation(nreads, uniqs, fractions)
+
+    cell = get_cell_index(cb, barcodes)
+    mask = cell >= 0
+    cell, gx, n_reads = cell[mask], gx[mask], n_reads[mask]
+    umis = extrapolate(thin_curves(cell, n_reads, len(barcodes), fractions), fractions)
+    # reads of each (cell, gene)
+    order, starts = group_rows(cell, gx)
+    gene_reads = np.add.reduceat(n_reads[order], starts) if len(starts) else n_reads[:0]
+    genes = extrapolate(thin_curves(cell[order[starts]], gene_reads, len(barcodes), fractions), fractions)
+    return fraction_saturation, genes.astype(np.float32), umis.astype(np.float32)
+
+
+@utils.add_log
+def python_curves(bam_file, barcode_names, fractions, seed=0, multimapper="first"):
+    """
+    Saturation and median gene curves without numpy: shuffle a list of reads and count in one pass.
+    Needs about 100 bytes per read, several times more than the numpy shuffle mode.
+
+    Returns:
+        fraction_saturation, fraction_mg
+    """
+    cb_int, ub_int, gx_int = {}, {}, {}
+    multi_names = set()
+    reads = []
+    with pysam.AlignmentFile(bam_file) as bam:
+        for record in bam:
+            cb = record.get_tag("CB")
+            ub = record.get_tag("UB")
+            gx = record.get_tag("GX")
+            if "-" in (cb, ub, gx):
+                continue
+            if record.get_tag("NH") > 1:
+                if multimapper == "primary":
+                    if record.get_tag("HI") != 1:
+                        continue
+                elif record.query_name in multi_names:
+                    continue
+                else:
+                    multi_names.add(record.query_name)
+            # use int instead of str to avoid memory hog
+            reads.append(
+                (
+                    cb_int.setdefault(cb, len(cb_int)),
+                    ub_int.setdefault(ub, len(ub_int)),
+                    gx_int.setdefault(gx, len(gx_int)),
+                )
+            )
+    del multi_names, ub_int, gx_int
+    utils.add_rows(len(reads))
+    random.Random(seed).shuffle(reads)
+
+    cells = {cb_int[x] for x in barcode_names if x in cb_int}
+    nreads = [int(len(reads) * fraction) for fraction in fractions]
+    seen, cell_genes = set(), defaultdict(set)
+    uniqs, fraction_mg = [], {}
+    read_iter = iter(reads)
+    start = 0
+    for fraction, nread in zip(fractions, nreads):
+        for read in islice(read_iter, nread - start):
+            seen.add(read)
+            if read[0] in cells:
+                cell_genes[read[0]].add(read[2])
+        start = nread
+        uniqs.append(len(seen))
+        n_genes = [len(x) for x in cell_genes.values()]
+        fraction_mg[fraction] = int(statistics.median(n_genes)) if n_genes else 0
+    return get_saturation(nreads, uniqs, fractions), fraction_mg
+
+
 def main(args):
     """main function"""
-    a, cb_dict = get_records(args.bam)
-    barcodes = read_one_col(args.cell_barcode)
-    barcodes = set(cb_dict[x] for x in barcodes)
-    random.seed(0)
-    random.shuffle(a)
-
-    fraction_saturation = sub_saturation(a)
-    fraction_mg = sub_gene(a, barcodes)
+    barcode_names = utils.read_one_col(args.cell_barcode)
+    fractions = get_fractions(args.steps)
+    curves = None
+    if np is None:
+        if args.mode != "shuffle":
+            sys.exit(f"Error: numpy is required for --mode {args.mode}.")
+        logger.warning("numpy is not installed. Shuffle reads in a Python list and skip the per-cell curves.")
+        fraction_saturation, fraction_mg = python_curves(
+            args.bam, barcode_names, fractions, args.seed, args.multimapper
+        )
+    elif args.mode == "analytic":
+        fractions = get_fractions(args.steps, args.max_fraction)
+        if args.molecules:
+            cb, ub, gx, n_reads, cb_encoder = load_molecules(args.molecules)
+        else:
+            cb, ub, gx, cb_encoder, n_dedup = get_records(args.bam, args.thread, args.multimapper)
+            logger.info(f"{len(cb)} reads. {n_dedup} multimapped alignments deduplicated")
+            cb, ub, gx, n_reads = get_molecules(cb, ub, gx)
+            save_molecules(f"{args.sample}.scrna.molecules.npz", cb, ub, gx, n_reads, cb_encoder)
+        logger.info(f"{len(n_reads)} molecules")
+        barcodes = np.array([cb_encoder.encode(x) for x in barcode_names], dtype=np.int64)
+        fraction_saturation, genes, umis = analytic_curves(cb, ub, gx, n_reads, barcodes, fractions)
+    elif args.mode == "stream":
+        cb_encoder = SeqEncoder()
+        barcodes = np.array([cb_encoder.encode(x) for x in barcode_names], dtype=np.int64)
+        fraction_saturation, genes, umis = stream_curves(args, barcodes, cb_encoder)
+    else:
+        *columns, cb_encoder, n_dedup = get_records(args.bam, args.thread, args.multimapper)
+        logger.info(f"{len(columns[0])} reads. {n_dedup} multimapped alignments deduplicated")
+        barcodes = np.array([cb_encoder.encode(x) for x in barcode_names], dtype=np.int64)
+        cb, ub, gx = shuffle_columns(columns, args.seed)
+        fraction_saturation = sub_saturation(first_occurrence(cb, ub, gx), len(cb), fractions)
+        genes, umis = sub_cell(cb, ub, gx, barcodes, fractions)
+    if np is not None:
+        fraction_mg = sub_gene(genes, fractions)
+        curves = {"barcodes": np.array(barcode_names), "fractions": np.array(fractions), "genes": genes}
+        if umis is not None:
+            curves["umis"] = umis
     saturation_file = f"{args.sample}.scrna.saturation.json"
     median_gene_file = f"{args.sample}.scrna.median_gene.json"
     # write json
@@ -109,12 +905,54 @@ def main(args):
         f.write(json.dumps(fraction_saturation))
     with open(median_gene_file, "w") as f:
         f.write(json.dumps(fraction_mg))
+    # unique molecules of sketch mode are HyperLogLog estimates
+    with open(f"{args.sample}.scrna.subsample.json", "w") as f:
+        f.write(json.dumps({"mode": args.mode, "approximate": args.mode == "stream" and args.sketch}))
+    # per-cell curves
+    if curves is not None:
+        np.savez_compressed(f"{args.sample}.scrna.subsample.npz", **curves)
+    utils.write_perf(args.sample, "scrna", "subsample")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="saturation")
-    parser.add_argument("-b", "--bam", help="bam file", required=True)
+    parser.add_argument("-b", "--bam", help="bam file")
     parser.add_argument("-c", "--cell_barcode", help="barcode file", required=True)
     parser.add_argument("-s", "--sample", help="sample name", required=True)
+    parser.add_argument("--thread", type=int, default=1, help="number of processes to scan bam regions")
+    parser.add_argument(
+        "--steps", type=int, default=100, help="number of points of the saturation and median gene curves"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["analytic", "shuffle", "stream"],
+        default="shuffle",
+        help="shuffle: load all reads and shuffle them. "
+        "analytic: expected (float) curves from the molecule table by binomial thinning. "
+        "stream: read the bam once and assign reads to fractions by the hash of read names, "
+        "memory is O(unique molecules)",
+    )
+    parser.add_argument(
+        "--sketch", action="store_true", help="stream mode: estimate unique molecules with HyperLogLog sketches"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--multimapper",
+        choices=["first", "primary"],
+        help="first: keep the first valid alignment of multimapped reads in bam order. "
+        "primary: keep the HI == 1 alignment, which needs no read name table. "
+        "Default: primary in stream mode, first otherwise",
+    )
+    parser.add_argument(
+        "--molecules", help="analytic mode: molecule table npz written by a previous run. The bam is not read"
+    )
+    parser.add_argument(
+        "--max_fraction", type=float, default=1.0, help="analytic mode: extrapolate curves up to this fraction of reads"
+    )
     args = parser.parse_args()
+    if args.multimapper is None:
+        # the read name table of "first" would grow with the multimapped reads in stream mode
+        args.multimapper = "primary" if args.mode == "stream" else "first"
+    if not args.bam and not (args.mode == "analytic" and args.molecules):
+        parser.error("--bam is required unless --molecules is used in analytic mode")
     main(args)
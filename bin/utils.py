@@ -1,19 +1,161 @@
 import csv
 import gzip
+import io
 import json
 import logging
+import os
+import resource
+import shutil
+import signal
+import subprocess
 import sys
 import time
 from datetime import timedelta
 from functools import wraps
 
+try:
+    import numpy as np
+except ImportError:
+    # get_umi_count needs numpy; the other helpers are used in containers without it
+    np = None
 
-def openfile(file_name, mode="rt", **kwargs):
-    """open gzip or plain file"""
-    if file_name.endswith(".gz"):
-        file_obj = gzip.open(file_name, mode=mode, **kwargs)
+# optional faster gzip backends
+try:
+    from isal import igzip as isal_gzip
+except ImportError:
+    isal_gzip = None
+try:
+    from zlib_ng import gzip_ng
+except ImportError:
+    gzip_ng = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+BUFFER_SIZE = 2**20
+
+
+class ProcessFile(io.RawIOBase):
+    """
+    Binary file object that reads from the stdout of a (de)compression command, or writes to its stdin.
+    """
+
+    def __init__(self, args, file_name, mode="rb"):
+        super().__init__()
+        self.args = args
+        self.reading = "r" in mode
+        if self.reading:
+            self.out = None
+            self.proc = subprocess.Popen(args + [file_name], stdout=subprocess.PIPE)
+            self.pipe = self.proc.stdout
+        else:
+            self.out = open(file_name, mode)
+            self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=self.out)
+            self.pipe = self.proc.stdin
+
+    def readable(self):
+        return self.reading
+
+    def writable(self):
+        return not self.reading
+
+    def readinto(self, b):
+        return self.pipe.readinto(b)
+
+    def write(self, b):
+        return self.pipe.write(b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.pipe.close()
+        returncode = self.proc.wait()
+        if self.out:
+            self.out.close()
+        super().close()
+        # a reader closed before the end of the file gets SIGPIPE
+        if returncode and not (self.reading and returncode == -signal.SIGPIPE):
+            raise OSError(f"{' '.join(self.args)} exited with code {returncode}")
+
+
+def get_compression(file_name, mode):
+    """
+    Returns:
+        "gzip", "zstd" or None. Sniff the magic bytes when reading; use the suffix when writing.
+    """
+    if "r" not in mode:
+        if file_name.endswith(".gz"):
+            return "gzip"
+        if file_name.endswith(".zst"):
+            return "zstd"
+        return None
+    with open(file_name, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def open_gzip(file_name, mode, compresslevel):
+    """
+    open gzip and BGZF in binary mode with the fastest available backend: python-isal, zlib-ng, pigz, then gzip
+    """
+    if isal_gzip:
+        # isal compression levels are 0-3
+        return isal_gzip.open(file_name, mode, compresslevel=min(compresslevel, 3))
+    if gzip_ng:
+        return gzip_ng.open(file_name, mode, compresslevel=compresslevel)
+    if shutil.which("pigz"):
+        args = ["pigz", "-dc"] if "r" in mode else ["pigz", "-c", f"-{compresslevel}"]
+        return ProcessFile(args, file_name, mode)
+    return gzip.open(file_name, mode, compresslevel=compresslevel)
+
+
+def open_zstd(file_name, mode):
+    if zstandard:
+        return zstandard.open(file_name, mode)
+    if shutil.which("zstd"):
+        args = ["zstd", "-dc"] if "r" in mode else ["zstd", "-c"]
+        return ProcessFile(args, file_name, mode)
+    sys.exit(f"Error: zstandard or zstd is required to open {file_name}")
+
+
+def openfile(file_name, mode="rt", compresslevel=6, **kwargs):
+    """
+    open gzip, BGZF, zstd or plain file with a large buffer.
+    Compressed input is recognized by magic bytes; output is compressed by the .gz or .zst suffix.
+    kwargs are passed to io.TextIOWrapper in text mode.
+
+    >>> import tempfile, os
+    >>> fn = os.path.join(tempfile.mkdtemp(), "a.txt.gz")
+    >>> with openfile(fn, "wt") as f:
+    ...     _ = f.write("a\\nb\\n")
+    >>> os.rename(fn, fn[:-3])
+    >>> read_one_col(fn[:-3])
+    ['a', 'b']
+    """
+    binary_mode = mode.replace("t", "")
+    if "b" not in binary_mode:
+        binary_mode += "b"
+    compression = get_compression(file_name, mode)
+    if compression == "gzip":
+        file_obj = open_gzip(file_name, binary_mode, compresslevel)
+    elif compression == "zstd":
+        file_obj = open_zstd(file_name, binary_mode)
     else:
-        file_obj = open(file_name, mode=mode, **kwargs)
+        return open(file_name, mode, buffering=BUFFER_SIZE, **kwargs)
+    if "r" in mode:
+        file_obj = io.BufferedReader(file_obj, BUFFER_SIZE)
+    else:
+        file_obj = io.BufferedWriter(file_obj, BUFFER_SIZE)
+    if "b" not in mode:
+        file_obj = io.TextIOWrapper(file_obj, **kwargs)
     return file_obj
 
 
@@ -50,15 +192,95 @@ def get_frac(raw_frac: float):
 
 def csv2dict(csv_file):
     data = {}
-    reader = csv.reader(openfile(csv_file))
-    for row in reader:
-        data[row[0]] = row[1]
+    with openfile(csv_file, newline="") as f:
+        for row in csv.reader(f):
+            data[row[0]] = row[1]
     return data
 
 
+# {step: {"calls", "wall_seconds", "cpu_seconds", "peak_rss_mb", "read_mb", "write_mb", "rows"}} of add_log steps
+PERF_STATS = {}
+# {"rows", "peak_rss_mb"} of the running add_log steps, innermost last
+_PERF_STACK = []
+
+
+def get_cpu_seconds():
+    """user and system time of this process and its waited children"""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def reset_peak_rss():
+    """
+    reset the peak RSS of this process (VmHWM) to the current RSS.
+
+    Returns:
+        False if /proc/self/clear_refs is not writable (e.g. not linux); the peak is then the process lifetime peak
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def get_peak_rss_mb():
+    """peak resident set size of this process since the last reset_peak_rss, or since it started"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def get_children_peak_rss_mb():
+    """largest peak RSS of the waited children so far. It can not be reset"""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def get_io_bytes():
+    """
+    Returns:
+        bytes read and written by this process through read/write calls. (0, 0) if /proc is not available
+    """
+    io_bytes = {}
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                io_bytes[key] = int(value)
+    except OSError:
+        return 0, 0
+    return io_bytes.get("rchar", 0), io_bytes.get("wchar", 0)
+
+
+def add_rows(n):
+    """count rows processed by the innermost running add_log step"""
+    if _PERF_STACK:
+        _PERF_STACK[-1]["rows"] += n
+
+
 def add_log(func):
     """
     logging start and done.
+    Wall time, CPU time, peak RSS, bytes read and written and rows (see add_rows) of each call are added to PERF_STATS.
+    The peak RSS is reset at the start of each call, so it is the peak of the call itself
+    (or of the process lifetime where the peak can not be reset), including waited child processes
+    whose peak grew during the call.
+
+    >>> @add_log
+    ... def count(n):
+    ...     add_rows(n)
+    >>> count(3); count(4)
+    >>> PERF_STATS["count"]["calls"], PERF_STATS["count"]["rows"]
+    (2, 7)
     """
     log_formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
@@ -67,6 +289,8 @@ def add_log(func):
     logger_name = f"{module}.{name}"
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.INFO)
+    # the module logger of the script is its parent and has its own handler; do not log twice
+    logger.propagate = False
 
     console_handler = logging.StreamHandler(sys.stderr)
     console_handler.setFormatter(log_formatter)
@@ -76,8 +300,38 @@ def add_log(func):
     def wrapper(*args, **kwargs):
         logger.info("start...")
         start = time.time()
-        result = func(*args, **kwargs)
+        cpu_start = get_cpu_seconds()
+        read_start, write_start = get_io_bytes()
+        children_start = get_children_peak_rss_mb()
+        if _PERF_STACK:
+            # keep the peak of the outer step before resetting it
+            _PERF_STACK[-1]["peak_rss_mb"] = max(_PERF_STACK[-1]["peak_rss_mb"], get_peak_rss_mb())
+        reset_peak_rss()
+        frame = {"rows": 0, "peak_rss_mb": 0}
+        _PERF_STACK.append(frame)
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            _PERF_STACK.pop()
+        peak_rss_mb = max(frame["peak_rss_mb"], get_peak_rss_mb())
+        children_end = get_children_peak_rss_mb()
+        if children_end > children_start:
+            peak_rss_mb = max(peak_rss_mb, children_end)
+        if _PERF_STACK:
+            _PERF_STACK[-1]["peak_rss_mb"] = max(_PERF_STACK[-1]["peak_rss_mb"], peak_rss_mb)
         end = time.time()
+        read_end, write_end = get_io_bytes()
+        stats = PERF_STATS.setdefault(
+            func.__qualname__,
+            {"calls": 0, "wall_seconds": 0, "cpu_seconds": 0, "peak_rss_mb": 0, "read_mb": 0, "write_mb": 0, "rows": 0},
+        )
+        stats["calls"] += 1
+        stats["wall_seconds"] += end - start
+        stats["cpu_seconds"] += get_cpu_seconds() - cpu_start
+        stats["peak_rss_mb"] = max(stats["peak_rss_mb"], peak_rss_mb)
+        stats["read_mb"] += (read_end - read_start) / 2**20
+        stats["write_mb"] += (write_end - write_start) / 2**20
+        stats["rows"] += frame["rows"]
         used = timedelta(seconds=end - start)
         logger.info("done. time used: %s", used)
         return result
@@ -91,40 +345,105 @@ def write_multiqc(data, sample, assay, step):
     write_json(data, fn)
 
 
+def write_perf(sample, assay, module):
+    """write PERF_STATS of the add_log steps in module to {sample}.{assay}.{module}.perf.json"""
+    if not PERF_STATS:
+        return
+    data = {}
+    for step, stats in PERF_STATS.items():
+        data[f"{module}.{step}"] = {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}
+    write_multiqc(data, sample, assay, f"{module}.perf")
+
+
 MAX_CELL = 10**5
 
 
-def get_umi_count(rbs, umis, cbs, sample):
+def get_log_bin_index(umis, start, end, n_point):
+    """
+    Pick about n_point indexes in [start, end) evenly spaced along the curve length in log rank - log UMI space,
+    so steep regions like the knee keep more points than flat ones. The first and last index are always kept.
+
+    >>> umis = np.array([1000, 900, 800, 50, 40, 30, 20, 10, 9, 8])
+    >>> get_log_bin_index(umis, 0, 10, 4).tolist()
+    [0, 3, 4, 9]
+    >>> get_log_bin_index(umis, 2, 5, 10).tolist()
+    [2, 3, 4]
+    """
+    if end - start <= n_point:
+        return np.arange(start, end)
+    x = np.log10(np.arange(start + 1, end + 1))
+    y = np.log10(umis[start:end])
+    length = np.concatenate([[0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))])
+    index = np.searchsorted(length, np.linspace(0, length[-1], n_point))
+    index[-1] = end - start - 1
+    return np.unique(index) + start
+
+
+def get_string_keys(a):
+    """
+    Integer columns, most significant first, that sort in the same order as a fixed-width str or bytes array.
+    Sorting integers is much faster than sorting strings.
+
+    >>> a = np.array([b"AC", b"A", b"ABCDEFGHIJ"])
+    >>> np.lexsort(get_string_keys(a)[::-1]).tolist()
+    [1, 2, 0]
+    """
+    if a.dtype.kind == "S" and a.dtype.itemsize:
+        width = -(-a.dtype.itemsize // 8) * 8
+        words = np.ascontiguousarray(a, dtype=f"S{width}").view(">u8").reshape(len(a), -1)
+    elif a.dtype.kind == "U" and a.dtype.itemsize:
+        words = np.ascontiguousarray(a).view(np.uint32).reshape(len(a), -1)
+    else:
+        return [a]
+    return [words[:, i] for i in range(words.shape[1])]
+
+
+@add_log
+def get_umi_count(rbs, umis, cbs, sample, n_point=None):
     """
     Args:
         rbs: raw barcodes
         umis: umi count
         cbs: cell barcodes
+        n_point: if set, keep about n_point log-binned points of each segment instead of every barcode
+
+    Returns:
+        {segment name: {barcode rank: umi count}}
+
+    >>> get_umi_count(["a", "b", "c", "d", "e"], [50, 40, 30, 0, 20], ["a", "c"], "s")
+    first non-cell barcode rank: 1
+    {'s.cells.pure(1/1, 100%)': {1: 50}, 's.cells.background(0/3, 0%)': {4: 20}, 's.cells.mix(1/2, 50.0%)': {2: 40, 3: 30}}
     """
-    a = [(umi, bc) for umi, bc in zip(umis, rbs) if umi > 0]
-    a.sort(reverse=True)
-    cbs = set(cbs)
+    rbs = np.asarray(rbs)
+    umis = np.asarray(umis)
+    add_rows(len(umis))
+    keep = umis > 0
+    rbs, umis = rbs[keep], umis[keep]
+    # same order as sorting (umi, barcode) in reverse
+    order = np.lexsort(get_string_keys(rbs)[::-1] + [umis])[::-1]
+    umis = umis[order]
+    is_cell = np.isin(rbs[order], np.asarray(cbs))
     plot_data = {}
-    n = len(a)
-    first_noncell = n - 1
-    for i, (umi, bc) in enumerate(a):
-        if bc not in cbs:
-            first_noncell = i
-            break
+    n = len(umis)
+    noncell_index = np.flatnonzero(~is_cell)
+    first_noncell = int(noncell_index[0]) if len(noncell_index) else n - 1
     print(f"first non-cell barcode rank: {first_noncell}")
-    last_cell = 0
-    for i in range(min(n - 1, MAX_CELL), -1, -1):
-        bc = a[i][1]
-        if bc in cbs:
-            last_cell = i
-            break
+    cell_index = np.flatnonzero(is_cell[: min(n - 1, MAX_CELL) + 1])
+    last_cell = int(cell_index[-1]) if len(cell_index) else 0
+
+    def to_dict(index):
+        return dict(zip((index + 1).tolist(), umis[index].tolist()))
+
+    def segment(start, end, step=1):
+        if n_point:
+            return to_dict(get_log_bin_index(umis, start, end, n_point))
+        return to_dict(np.arange(start, end, step))
+
     pure = sample + ".cells.pure" + f"({first_noncell}/{first_noncell}, 100%)"
     bg_cells = n - first_noncell
     bg = sample + ".cells.background" + f"(0/{bg_cells}, 0%)"
-    plot_data[pure] = {}
+    plot_data[pure] = segment(0, max(first_noncell, 0))
     plot_data[bg] = {}
-    for i in range(first_noncell):
-        plot_data[pure][i + 1] = int(a[i][0])
 
     n_mix = last_cell - first_noncell + 1
     if n_mix != 0:
@@ -132,13 +451,12 @@ def get_umi_count(rbs, umis, cbs, sample):
         n_mix_cell = n_total - first_noncell
         mix_rate = round(n_mix_cell / n_mix * 100, 2)
         mix = sample + ".cells.mix" + f"({n_mix_cell}/{n_mix}, {mix_rate}%)"
-        plot_data[mix] = {}
-        for i in range(first_noncell, last_cell + 1):
-            plot_data[mix][i + 1] = int(a[i][0])
-
-    for i in range(last_cell + 1, min(MAX_CELL, n), 10):
-        plot_data[bg][i + 1] = int(a[i][0])
-    # do not record every umi count
-    for i in range(MAX_CELL, n, 1000):
-        plot_data[bg][i + 1] = int(a[i][0])
+        plot_data[mix] = segment(first_noncell, last_cell + 1)
+
+    if n_point:
+        plot_data[bg] = segment(last_cell + 1, n)
+    else:
+        plot_data[bg] = segment(last_cell + 1, min(MAX_CELL, n), 10)
+        # do not record every umi count
+        plot_data[bg].update(segment(MAX_CELL, n, 1000))
     return plot_data
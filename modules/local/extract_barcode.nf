@@ -0,0 +1,55 @@
+process EXTRACT_BARCODE {
+    tag "$meta.id"
+    label 'process_medium'
+
+    conda 'bioconda::pyfastx=2.1.0 conda-forge::numpy==1.26.4'
+    // without numpy in the image, protocol detection checks reads one by one
+    container "biocontainers/pyfastx:2.1.0--py39h3d4b85c_0"
+
+    input:
+    //
+    // Input reads are expected to come as: [ meta, [ pair1_read1, pair1_read2, pair2_read1, pair2_read2 ] ]
+    //
+    tuple val(meta), path(reads, stageAs: "?/*")
+    path assets_dir
+    val protocol
+
+    output:
+    tuple val(meta), path("${meta.id}_R{1,2}.fq.gz"), emit: reads
+    tuple val(meta), path("${meta.id}.starsolo_cmd.txt"), emit: starsolo_cmd
+    tuple val(meta), path("${meta.id}.scrna.*.json"), emit: json
+    tuple val(meta), path("${meta.id}.scrna.extract_barcode.json"), emit: stats
+    path  "versions.yml" , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    def args = task.ext.args ?: ''
+    def prefix = "${meta.id}"
+
+    // separate forward from reverse pairs
+    def (forward, reverse) = reads.collate(2).transpose()
+    def pattern = params.pattern ? "--pattern ${params.pattern}" : ""
+    def whitelist = params.whitelist ? "--whitelist \'${params.whitelist}\'" : ""
+    def cache_dir = params.protocol_cache_dir ? "--cache_dir ${params.protocol_cache_dir}" : ""
+    """
+    extract_barcode.py \\
+        --sample ${prefix} \\
+        --fq1 ${forward.join( "," )} \\
+        --fq2 ${reverse.join( "," )} \\
+        --assets_dir ${assets_dir} \\
+        --protocol ${protocol} \\
+        --thread ${task.cpus} \\
+        $pattern \\
+        $whitelist \\
+        $cache_dir \\
+        $args
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        pyfastx: \$(pyfastx --version | sed -e "s/pyfastx version //g")
+    END_VERSIONS
+    """
+}
@@ -0,0 +1,34 @@
+process MTX_TO_H5 {
+    tag "$meta.id"
+    label 'process_single'
+
+    conda 'bioconda::scanpy==1.7.2'
+    // h5py, numpy and pandas
+    container "biocontainers/scanpy:1.7.2--pyhdfd78af_0"
+
+    input:
+    tuple val(meta), path(matrix)
+
+    output:
+    tuple val(meta), path("*.h5"), emit: h5
+    tuple val(meta), path("*.json"), emit: json
+    path  "versions.yml" , emit: versions
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    """
+    mtx_to_h5.py \\
+        --matrix_dir ${matrix}/raw ${matrix}/filtered \\
+        --out ${meta.id}.raw_feature_bc_matrix.h5 ${meta.id}.filtered_feature_bc_matrix.h5 \\
+        --sample ${meta.id}
+
+    cat <<-END_VERSIONS > versions.yml
+    "${task.process}":
+        h5py: \$(python -c "import h5py; print(h5py.__version__)")
+        numpy: \$(python -c "import numpy; print(numpy.__version__)")
+    END_VERSIONS
+    """
+}
@@ -2,7 +2,8 @@ process PROTOCOL_CMD {
     tag "$meta.id"
     label 'process_single'
 
-    conda 'bioconda::pyfastx=2.1.0'
+    conda 'bioconda::pyfastx=2.1.0 conda-forge::numpy==1.26.4'
+    // without numpy in the image, protocol detection checks reads one by one
     container "biocontainers/pyfastx:2.1.0--py39h3d4b85c_0"
 
     input:
@@ -24,12 +25,14 @@ process PROTOCOL_CMD {
 
     script:
 
+    def args = task.ext.args ?: ''
     def prefix = "${meta.id}"
 
     // separate forward from reverse pairs
     def (forward, reverse) = reads.collate(2).transpose()
     def pattern = params.pattern ? "--pattern ${params.pattern}" : ""
     def whitelist = params.whitelist ? "--whitelist \'${params.whitelist}\'" : ""
+    def cache_dir = params.protocol_cache_dir ? "--cache_dir ${params.protocol_cache_dir}" : ""
     """
     protocol_cmd.py \\
         --sample ${prefix} \\
@@ -37,8 +40,11 @@ process PROTOCOL_CMD {
         --fq2 ${reverse.join( "," )} \\
         --assets_dir ${assets_dir} \\
         --protocol ${protocol} \\
+        --thread ${task.cpus} \\
         $pattern \\
-        $whitelist
+        $whitelist \\
+        $cache_dir \\
+        $args
 
     cat <<-END_VERSIONS > versions.yml
     "${task.process}":
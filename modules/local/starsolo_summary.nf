@@ -1,23 +1,27 @@
 process STARSOLO_SUMMARY {
     tag "$meta.id"
-    label 'process_single'
+    label 'process_low'
 
     conda 'conda-forge::pandas==1.5.2'
     container "biocontainers/pandas:1.5.2"
 
     input:
-    tuple val(meta), path(read_stats), path(summary), path(filtered_matrix)
+    tuple val(meta), path(read_stats), path(summary), path(filtered_matrix), path(solo_out)
 
     output:
     tuple val(meta), path("*.json"), emit: json
 
     script:
+    def args = task.ext.args ?: ''
 
     """
     starsolo_summary.py \\
         --read_stats ${read_stats} \\
         --filtered_matrix ${filtered_matrix} \\
         --summary ${summary} \\
-        --sample ${meta.id}
+        --sample ${meta.id} \\
+        --solo_out ${solo_out} \\
+        --thread ${task.cpus} \\
+        ${args}
     """
 }
\ No newline at end of file
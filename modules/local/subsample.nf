@@ -1,9 +1,9 @@
 process SUBSAMPLE {
     tag "$meta.id"
-    cpus '1'
-    memory '32 GB'
+    label 'process_medium'
 
-    conda 'bioconda::pysam==0.22.1'
+    conda 'bioconda::pysam==0.22.1 conda-forge::numpy==1.26.4'
+    // numpy is not in the pysam image; subsample.py falls back to a pure Python shuffle without it
     container "biocontainers/pysam:0.22.1--py38h15b938a_0"
 
     input:
@@ -11,13 +11,17 @@ process SUBSAMPLE {
 
     output:
     tuple val(meta), path("*.json"), emit: json
+    tuple val(meta), path("*.npz"), emit: npz, optional: true
 
     script:
+    def args = task.ext.args ?: ''
 
     """
     subsample.py \\
         -b ${bam} \\
         -c ${barcodes} \\
-        -s ${meta.id}
+        -s ${meta.id} \\
+        --thread ${task.cpus} \\
+        ${args}
     """
 }
\ No newline at end of file
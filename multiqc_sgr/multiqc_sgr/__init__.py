@@ -13,6 +13,18 @@ def multiqc_sgr_config():
         "scrna/median_gene": {
             "fn": "*scrna.median_gene.json",
         },
+        "scrna/subsample": {
+            "fn": "*scrna.subsample.json",
+        },
+        "scrna/extract_barcode": {
+            "fn": "*scrna.extract_barcode.json",
+        },
+        "scrna/features": {
+            "fn": "*scrna.features.json",
+        },
+        "scrna/perf": {
+            "fn": "*scrna.*perf.json",
+        },
         "scsnp/stats": {"fn": "*scsnp.*stats.json"},
         "scsnp/gene": {"fn": "*scsnp.gene.json"},
         "scsnp/count": {"fn": "*scsnp.count.json"},
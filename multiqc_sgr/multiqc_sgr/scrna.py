@@ -3,7 +3,7 @@ import logging
 from collections import defaultdict
 
 from multiqc.modules.base_module import BaseMultiqcModule, ModuleNoSamplesFound
-from multiqc.plots import linegraph
+from multiqc.plots import linegraph, table
 
 # Initialise the logger
 log = logging.getLogger("multiqc")
@@ -27,6 +27,10 @@ class MultiqcModule(BaseMultiqcModule):
         umi_count_data = self.parse_json(self.name, "umi_count")
         saturation_data = self.parse_json(self.name, "saturation")
         median_gene_data = self.parse_json(self.name, "median_gene")
+        subsample_data = self.parse_json(self.name, "subsample")
+        features_data = self.parse_json(self.name, "features")
+        extract_barcode_data = self.parse_json(self.name, "extract_barcode")
+        perf_data = self.parse_json(self.name, "perf")
         if all(len(x) == 0 for x in [stat_data, umi_count_data, saturation_data, median_gene_data]):
             raise ModuleNoSamplesFound
 
@@ -38,12 +42,48 @@ class MultiqcModule(BaseMultiqcModule):
 
         # subsample
         if saturation_data:
-            self.add_section(name="Saturation", anchor="scrna_subsample", plot=self.saturation_plot(saturation_data))
+            approximate = [sample for sample in saturation_data if subsample_data.get(sample, {}).get("approximate")]
+            description = ""
+            if approximate:
+                description = f"Approximate (HyperLogLog estimates of unique molecules): {', '.join(approximate)}"
+            self.add_section(
+                name="Saturation",
+                anchor="scrna_subsample",
+                description=description,
+                plot=self.saturation_plot(saturation_data),
+            )
         if median_gene_data:
             self.add_section(
                 name="Median Gene", anchor="scrna_median_gene", plot=self.median_gene_plot(median_gene_data)
             )
 
+        # barcode extraction
+        if extract_barcode_data:
+            self.add_section(
+                name="Barcode Extraction",
+                anchor="scrna_extract_barcode",
+                description="Perfect, corrected and invalid reads of each barcode segment and reads rescued by linker anchoring.",
+                plot=self.extract_barcode_table(extract_barcode_data),
+            )
+
+        # STARsolo features
+        if features_data:
+            self.add_section(
+                name="Features",
+                anchor="scrna_features",
+                description="Summary of each STARsolo feature (soloFeatures) for the same cell barcodes.",
+                plot=self.features_table(features_data),
+            )
+
+        # resource usage of each step
+        if perf_data:
+            self.add_section(
+                name="Performance",
+                anchor="scrna_perf",
+                description="Wall time, CPU time, peak memory, I/O and rows processed of each instrumented step.",
+                plot=self.perf_table(perf_data),
+            )
+
         # Superfluous function call to confirm that it is used in this module
         # Replace None with actual version if it is available
         self.add_software_version(None)
@@ -247,6 +287,46 @@ class MultiqcModule(BaseMultiqcModule):
 
         return linegraph.plot(plot_data, pconfig)
 
+    def extract_barcode_table(self, extract_barcode_data):
+        table_config = {
+            "id": "scrna_extract_barcode",
+            "title": "scrna: Barcode Extraction",
+        }
+        return table.plot(extract_barcode_data, pconfig=table_config)
+
+    def features_table(self, features_data):
+        feature_stats = {}
+        for sample in features_data:
+            for feature in features_data[sample]:
+                feature_stats[f"{sample} {feature}"] = features_data[sample][feature]
+        table_config = {
+            "id": "scrna_features",
+            "title": "scrna: Features",
+            "col1_header": "Sample Feature",
+        }
+        return table.plot(feature_stats, pconfig=table_config)
+
+    def perf_table(self, perf_data):
+        step_perf = {}
+        for sample in perf_data:
+            for step in perf_data[sample]:
+                step_perf[f"{sample} {step}"] = perf_data[sample][step]
+        headers = {
+            "calls": {"title": "Calls", "format": "{:,.0f}"},
+            "wall_seconds": {"title": "Wall Time", "suffix": " s", "scale": "Oranges"},
+            "cpu_seconds": {"title": "CPU Time", "suffix": " s", "scale": "Oranges"},
+            "peak_rss_mb": {"title": "Peak RSS", "suffix": " MB", "scale": "Reds"},
+            "read_mb": {"title": "Read", "suffix": " MB", "scale": "Blues"},
+            "write_mb": {"title": "Written", "suffix": " MB", "scale": "Blues"},
+            "rows": {"title": "Rows", "format": "{:,.0f}", "scale": "Greens"},
+        }
+        table_config = {
+            "id": "scrna_perf",
+            "title": "scrna: Performance",
+            "col1_header": "Sample Step",
+        }
+        return table.plot(step_perf, headers, pconfig=table_config)
+
     def saturation_plot(self, saturation_data):
         # Config for the plot
         pconfig = {
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+benchmark_parse_protocol.py --save_baseline baseline.json
+benchmark_parse_protocol.py --baseline baseline.json
+time and memory-profile the hot paths of bin/parse_protocol.py on synthetic whitelists and reads of every protocol
+in assets/protocols.json. Exit with an error if any benchmark regresses beyond the allowed ratio against the baseline.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "bin"))
+
+import parse_protocol  # noqa: E402
+
+BASES = "ACGT"
+# protocols that Auto can detect
+AUTO_PROTOCOLS = parse_protocol.BARCODE_PROTOCOLS + ["GEXSCOPE-MicroBead"]
+# benchmarks with a smaller absolute change than this are never reported as regressions.
+# Runs of a few ms vary by tens of percent between runs on a shared machine
+MIN_SECONDS = 0.05
+# short benchmarks are looped until one timing takes at least this long, and the mean per call is reported
+MIN_TIMING_SECONDS = 0.2
+MIN_PEAK_MB = 1.0
+
+
+def random_seq(length, rng):
+    return "".join(rng.choice(BASES) for _ in range(length))
+
+
+def mutate(seq, rng):
+    """introduce one mismatch"""
+    pos = rng.randrange(len(seq))
+    return seq[:pos] + rng.choice([x for x in BASES if x != seq[pos]]) + seq[pos + 1 :]
+
+
+def read_lines(fn):
+    with open(fn) as f:
+        return [x.strip() for x in f if x.strip()]
+
+
+def get_whitelists(protocol_meta, tmp_dir, n_barcode, rng):
+    """
+    Returns:
+        whitelist files: the protocol's own, or synthetic ones for protocols without a whitelist
+    """
+    if protocol_meta.get("bc"):
+        return protocol_meta["bc"]
+    files = []
+    for i, sub_slice in enumerate(protocol_meta["pattern_dict"]["C"]):
+        fn = os.path.join(tmp_dir, f"bc{i}.txt")
+        with open(fn, "w") as f:
+            for _ in range(n_barcode):
+                f.write(random_seq(sub_slice.stop - sub_slice.start, rng) + "\n")
+        files.append(fn)
+    return files
+
+
+def make_read(pattern_dict, whitelists, linkers, rng, mismatch_rate=0.1, read_len=150):
+    segments = []
+    for sub_slice in sorted((x for v in pattern_dict.values() for x in v), key=lambda x: x.start):
+        length = sub_slice.stop - sub_slice.start
+        segments.append((sub_slice.start, length))
+    parts = {}
+    for key, slices in pattern_dict.items():
+        for i, sub_slice in enumerate(slices):
+            length = sub_slice.stop - sub_slice.start
+            if key == "C":
+                seq = rng.choice(whitelists[i])
+                if rng.random() < mismatch_rate:
+                    seq = mutate(seq, rng)
+            elif key == "L" and i < len(linkers):
+                seq = linkers[i][:length].ljust(length, "A")
+            elif key == "T":
+                seq = "T" * length
+            else:
+                seq = random_seq(length, rng)
+            parts[sub_slice.start] = seq
+    read = "".join(parts[start] for start, _length in segments)
+    # GEXSCOPE-MicroBead reads are recognized by the poly T after the UMI
+    read += "CC" + "T" * 30
+    return (read + random_seq(read_len, rng))[:read_len]
+
+
+def write_fastq(fn, reads):
+    with gzip.open(fn, "wt") as f:
+        for i, read in enumerate(reads):
+            f.write(f"@read{i}\n{read}\n+\n{'F' * len(read)}\n")
+
+
+def time_per_call(func):
+    """mean seconds per call over enough calls to take MIN_TIMING_SECONDS, like timeit autorange"""
+    n_call = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n_call):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIMING_SECONDS:
+            return elapsed / n_call
+        n_call *= 2
+
+
+def measure(func, repeat):
+    """
+    Returns:
+        min of the per-call seconds of repeat timings after one warmup run, peak traced memory in MB of one extra run
+    """
+    # the first run pays for imports, file system caches and lazily built indexes
+    func()
+    seconds = [time_per_call(func) for _ in range(repeat)]
+    tracemalloc.start()
+    func()
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(min(seconds), 6), "peak_mb": round(peak / 2**20, 3)}
+
+
+def benchmark_protocol(protocol, protocol_meta, assets_dir, args, tmp_dir, rng):
+    """
+    Returns:
+        {benchmark name: {"seconds": x, "peak_mb": y}}
+    """
+    protocol_dir = os.path.join(tmp_dir, protocol)
+    os.makedirs(protocol_dir)
+    whitelist_files = get_whitelists(protocol_meta, protocol_dir, args.n_barcode, rng)
+    whitelists = [read_lines(fn) for fn in whitelist_files]
+    linkers = [read_lines(fn)[0] for fn in protocol_meta.get("linker", [])]
+    reads = [make_read(protocol_meta["pattern_dict"], whitelists, linkers, rng) for _ in range(args.n_read)]
+    fq1 = os.path.join(protocol_dir, "R1.fq.gz")
+    write_fastq(fq1, reads)
+    cb_slices = protocol_meta["pattern_dict"]["C"]
+    bc_lists = [[read[x] for x in cb_slices] for read in reads]
+
+    def cold_raw_mismatch():
+        with tempfile.TemporaryDirectory(dir=protocol_dir) as cache_dir:
+            parse_protocol.get_raw_mismatch(whitelist_files, 1, cache_dir)
+
+    cache_dir = os.path.join(protocol_dir, "cache")
+    os.makedirs(cache_dir)
+    raw_list, mismatch_list = parse_protocol.get_raw_mismatch(whitelist_files, 1, cache_dir)
+
+    def check_all():
+        for bc_list in bc_lists:
+            parse_protocol.check_seq_mismatch(bc_list, raw_list, mismatch_list)
+
+    results = {
+        "findall_mismatch": measure(
+            lambda: [parse_protocol.findall_mismatch(x) for x in whitelists[0][:1000]], args.repeat
+        ),
+        "get_mismatch_dict": measure(lambda: parse_protocol.get_mismatch_dict(whitelists[0]), args.repeat),
+        "get_raw_mismatch": measure(cold_raw_mismatch, args.repeat),
+        "get_raw_mismatch_cached": measure(
+            lambda: parse_protocol.get_raw_mismatch(whitelist_files, 1, cache_dir), args.repeat
+        ),
+        "check_seq_mismatch": measure(check_all, args.repeat),
+        "Auto.__init__": measure(
+            lambda: parse_protocol.Auto([fq1], protocol, assets_dir, cache_dir=cache_dir), args.repeat
+        ),
+    }
+    if protocol in AUTO_PROTOCOLS:
+        runner = parse_protocol.Auto([fq1], protocol, assets_dir, max_read=args.n_read, cache_dir=cache_dir)
+        detected = runner.get_fq_protocol(fq1)
+        if detected != protocol:
+            sys.exit(f"Error: synthetic {protocol} reads are detected as {detected}")
+        results["Auto.get_fq_protocol"] = measure(lambda: runner.get_fq_protocol(fq1), args.repeat)
+    return results
+
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    protocol_dict = parse_protocol.get_protocol_dict(args.assets_dir)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for protocol, protocol_meta in protocol_dict.items():
+            if args.protocol and protocol not in args.protocol:
+                continue
+            for name, value in benchmark_protocol(protocol, protocol_meta, args.assets_dir, args, tmp_dir, rng).items():
+                key = f"{protocol}/{name}"
+                results[key] = value
+                print(f"{key}\t{value['seconds']:.4f}s\t{value['peak_mb']:.2f}MB")
+    return results
+
+
+def compare(results, baseline, max_time_regression, max_memory_regression):
+    """
+    Returns:
+        list of regression messages
+
+    >>> baseline = {"a": {"seconds": 1.0, "peak_mb": 10.0}}
+    >>> compare({"a": {"seconds": 1.2, "peak_mb": 10.0}}, baseline, 0.5, 0.2)
+    []
+    >>> compare({"a": {"seconds": 2.0, "peak_mb": 20.0}}, baseline, 0.5, 0.2)
+    ['a: seconds 1.0 -> 2.0 (+100%)', 'a: peak_mb 10.0 -> 20.0 (+100%)']
+    """
+    regressions = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        for metric, max_ratio, min_diff in (
+            ("seconds", max_time_regression, MIN_SECONDS),
+            ("peak_mb", max_memory_regression, MIN_PEAK_MB),
+        ):
+            old, new = baseline[key][metric], value[metric]
+            if new - old > min_diff and new > old * (1 + max_ratio):
+                regressions.append(f"{key}: {metric} {old} -> {new} (+{(new - old) / old:.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--assets_dir", default=os.path.join(ROOT_DIR, "assets"))
+    parser.add_argument("--protocol", nargs="+", help="only benchmark these protocols")
+    parser.add_argument("--n_read", type=int, default=10000, help="number of synthetic reads per protocol")
+    parser.add_argument(
+        "--n_barcode", type=int, default=1000, help="whitelist size for protocols without a whitelist file"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="the minimum time of repeat runs is reported")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", help="baseline json to compare with")
+    parser.add_argument("--save_baseline", help="write results to this json")
+    parser.add_argument("--max_time_regression", type=float, default=0.5, help="allowed fraction of slowdown")
+    parser.add_argument("--max_memory_regression", type=float, default=0.2, help="allowed fraction of memory growth")
+    args = parser.parse_args()
+
+    # keep the cache hit/miss logs out of the timings
+    logging.disable(logging.INFO)
+
+    results = run_benchmarks(args)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=4)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_time_regression, args.max_memory_regression)
+        if regressions:
+            sys.exit("Error: performance regressions\n" + "\n".join(regressions))
+        print(f"No regressions against {args.baseline}")
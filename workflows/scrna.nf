@@ -7,10 +7,12 @@ include { FASTQC                 } from '../modules/nf-core/fastqc/main'
 include { FILTER_GTF             } from '../modules/local/filter_gtf'
 include { STAR_GENOME            } from '../modules/local/star_genome'
 include { PROTOCOL_CMD           } from '../modules/local/protocol_cmd'
+include { EXTRACT_BARCODE        } from '../modules/local/extract_barcode'
 include { STARSOLO               } from '../modules/local/starsolo'
 include { CELL_CALLING           } from '../modules/local/cell_calling'
 include { STARSOLO_SUMMARY       } from '../modules/local/starsolo_summary'
 include { SUBSAMPLE              } from '../modules/local/subsample'
+include { MTX_TO_H5              } from '../modules/local/mtx_to_h5'
 include { MULTIQC                } from '../modules/local/multiqc_sgr'
 
 include { paramsSummaryMap       } from 'plugin/nf-validation'
@@ -64,16 +66,30 @@ workflow SCRNA {
     }
 
     // create cmd
-    PROTOCOL_CMD (
-        ch_samplesheet,
-        "${projectDir}/assets/",
-        params.protocol,
-    )
-    ch_versions = ch_versions.mix(PROTOCOL_CMD.out.versions.first())
-    ch_multiqc_files = ch_multiqc_files.mix(PROTOCOL_CMD.out.json.collect{it[1]})
+    if (params.extract_barcode) {
+        EXTRACT_BARCODE (
+            ch_samplesheet,
+            "${projectDir}/assets/",
+            params.protocol,
+        )
+        ch_versions = ch_versions.mix(EXTRACT_BARCODE.out.versions.first())
+        ch_multiqc_files = ch_multiqc_files.mix(EXTRACT_BARCODE.out.json.collect{it[1]})
+        ch_reads = EXTRACT_BARCODE.out.reads
+        ch_starsolo_cmd = EXTRACT_BARCODE.out.starsolo_cmd
+    } else {
+        PROTOCOL_CMD (
+            ch_samplesheet,
+            "${projectDir}/assets/",
+            params.protocol,
+        )
+        ch_versions = ch_versions.mix(PROTOCOL_CMD.out.versions.first())
+        ch_multiqc_files = ch_multiqc_files.mix(PROTOCOL_CMD.out.json.collect{it[1]})
+        ch_reads = ch_samplesheet
+        ch_starsolo_cmd = PROTOCOL_CMD.out.starsolo_cmd
+    }
 
     // starsolo
-    ch_merge = ch_samplesheet.join(PROTOCOL_CMD.out.starsolo_cmd.map{ [it[0], it[1].text] })
+    ch_merge = ch_reads.join(ch_starsolo_cmd.map{ [it[0], it[1].text] })
     ch_whitelist = params.whitelist ? params.whitelist : []
     STARSOLO (
         ch_merge,
@@ -91,10 +107,17 @@ workflow SCRNA {
     ch_versions = ch_versions.mix(CELL_CALLING.out.versions.first())
 
     // statsolo summary
-    ch_merge = STARSOLO.out.read_stats.join(STARSOLO.out.summary).join(CELL_CALLING.out.filtered_matrix)           
+    ch_merge = STARSOLO.out.read_stats.join(STARSOLO.out.summary).join(CELL_CALLING.out.filtered_matrix).join(STARSOLO.out.solo_out)           
     STARSOLO_SUMMARY ( ch_merge )
     ch_multiqc_files = ch_multiqc_files.mix(STARSOLO_SUMMARY.out.json.collect{it[1]})
 
+    // 10x h5 matrix
+    if (params.run_h5) {
+        MTX_TO_H5 ( CELL_CALLING.out.matrix )
+        ch_multiqc_files = ch_multiqc_files.mix(MTX_TO_H5.out.json.collect{it[1]})
+        ch_versions = ch_versions.mix(MTX_TO_H5.out.versions.first())
+    }
+
     // subsample
     if (params.run_subsample) {
         ch_merge = STARSOLO.out.bam_sorted.join(CELL_CALLING.out.barcodes)                